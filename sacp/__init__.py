@@ -1,2 +1,26 @@
 from .base import *
 from .utilities import *
+from .node import *
+from .lint import *
+from .conditional import *
+from .effective import *
+from .matcher import *
+from .diff import *
+from .transaction import *
+from .resolver import *
+from .limits import *
+from .frozen import *
+from .columnar import *
+from .export import *
+from .store import *
+from .rewrite import *
+from .shared import *
+
+# Star imports don't go through __getattr__, list the lexer names base used to re-export so that from sacp import *
+# still provides them. Only star imports pay for importing the lexer, import sacp stays lazy.
+__all__ = [name for name in globals() if not name.startswith('_')] + sorted(base._lexer_names)
+
+
+def __getattr__(name):
+    # The pygments lexer names base used to re-export are imported on first use.
+    return base.__getattr__(name)
@@ -1,45 +1,182 @@
 from .node import *
-from pygments.lexers.configs import ApacheConfLexer, default, words, bygroups, include, using
 from pygments.token import Text, Comment as pygComment, Operator, Keyword, Name, String, \
     Number, Punctuation, Whitespace, Literal
+from .node import _token_type
+from .resolver import Resolver
+from .limits import ParseLimits, LimitExceeded, Cancelled, CancelToken
+import bisect
+import pickle
 import pygments
-import glob
+import re
+
+
+# Matches a single configuration argument, quoted sections are kept intact (quotes included) so that arguments such as
+# '"a b"' or '~"^/var/www"' are not split apart.
+_argument_re = re.compile(r'(?:"(?:[^"\\]|\\.)*"|[^\s"])+')
+
+# Skeleton parses replace whitespace between arguments with this one shared token.
+_space = (Token.Text.Whitespace, ' ')
+
+
+# Importing pygments' lexers is the bulk of the time it takes to import sacp, so the lexer is imported on first use and
+# the one instance is shared by every Parser that isn't given its own.
+_lexer = None
+
+# Names that used to be imported from pygments.lexers.configs, still available as attributes of the module.
+_lexer_names = frozenset(['ApacheConfLexer', 'default', 'words', 'bygroups', 'include', 'using'])
+
+
+def _default_lexer():
+    global _lexer
+    if _lexer is None:
+        from pygments.lexers.configs import ApacheConfLexer
+        _lexer = ApacheConfLexer(ensurenl=False, stripnl=False)
+    return _lexer
+
+
+# Always built by selective parses: they load the files or decide which parts of the config apply, and what was
+# selected may be found behind them.
+_always_selected = frozenset(['include', 'includeoptional', 'ifmodule', 'ifdefine', 'if', 'elseif', 'else',
+                              'ifversion', 'ifdirective', 'iffile', 'ifsection', 'define', 'undefine', 'loadmodule',
+                              'serverroot'])
+
+
+def __getattr__(name):
+    if name in _lexer_names:
+        import pygments.lexers.configs
+        return getattr(pygments.lexers.configs, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 class Parser:
-    def __init__(self, data, nodefactory=None, parent=None, acl=None):
+    def __init__(self, data, nodefactory=None, parent=None, acl=None, profile=None, resolver=None, skeleton=False,
+                 weak_parents=False, select=None, workers=None, shard_size=1 << 20, store=None, limits=None,
+                 recover=False, diagnostics=None):
         # Use specified node generator to generate nodes or use the default.
         if nodefactory is None:
             nodefactory = DefaultFactory()
         if not isinstance(nodefactory, NodeFactory):
             raise ValueError("nodefactory must be of type NodeFactory")
         self._nodefactory = nodefactory
+        self._acl = acl
 
         # Use specified lexer to generate tokens or use the default.
         if acl is None:
-            acl = ApacheConfLexer(ensurenl=False, stripnl=False)
-
-        if not isinstance(acl, ApacheConfLexer):
-            raise ValueError("acl must be of type ApacheConfLexer")
+            acl = _default_lexer()
+        else:
+            from pygments.lexers.configs import ApacheConfLexer
+            if not isinstance(acl, ApacheConfLexer):
+                raise ValueError("acl must be of type ApacheConfLexer")
 
         self._stream = pygments.lex(data, acl)
 
+        # When a ServerProfile is given conditional sections are evaluated against it, children of inactive sections
+        # are either marked inactive or, when the profile prunes, skipped without being built at all.
+        self.profile = profile
+        self._inactive = 0
+
+        # Include patterns are resolved through a Resolver shared by every file of the parse.
+        if resolver is None:
+            resolver = Resolver()
+        self.resolver = resolver
+
+        # Skeleton parses are for analysis only: comments and whitespace are dropped as they are lexed, so only
+        # directives & sections are built and each node records its line since tokens can no longer be counted.
+        # str() of such a tree does not reproduce the original file, see roundtrip.
+        self.skeleton = skeleton
+        self._line = 1
+
+        # Nodes hold weak references to their parents, trees then have no reference cycles and are freed as soon
+        # as they're unreachable rather than by the cyclic garbage collector.
+        self.weak_parents = weak_parents
+
+        # Selective parses only build the sections & directives selected, either a set of names or a predicate called
+        # with the lower case name. The others are kept as Unparsed nodes holding their raw tokens, sections are
+        # scanned to their close tag without being parsed so nothing inside them, e.g. Includes, is built or loaded.
+        if select is not None and not callable(select):
+            select = frozenset(name.lower() for name in select).__contains__
+        self.select = select
+
+        # The close tags of the sections skipped are found by scanning the lines of data and lexing resumes there, so
+        # their bodies are never lexed. That needs offsets in the lexed text to be offsets in data: with lexers that
+        # change the text, e.g. by stripping newlines, or data with carriage returns the bodies are lexed as before.
+        self._tags = None
+        if select is not None and '\r' not in data and data[:1] != '\ufeff' and \
+                not (acl.stripnl or acl.stripall or acl.ensurenl or acl.tabsize or acl.filters):
+            self._data = data
+            self._tags = _tag_lines(data)
+            self._offset = 0
+            self._seek = None
+            self._stream = self._lex(data, acl)
+
+        # Included files are loaded through an InternStore when given, identical files then share one frozen tree.
+        self.store = store
+
+        # ParseLimits bound the bytes, tokens, nodes, nesting & time of the parse and of the files it includes.
+        self.limits = limits
+        if limits is not None:
+            limits.read(data)
+            self._stream = limits.count_tokens(self._stream)
+
+        # Recovering parses don't stop at errors: text that can't be lexed becomes an ErrorNode holding the rest of
+        # its line and parsing carries on with the next line, missing includes & unclosed sections are reported too.
+        # Every problem found, including those of the included files, is added to diagnostics.
+        self.recover = recover
+        self.diagnostics = [] if diagnostics is None else diagnostics
+        # Names of the sections being parsed, innermost last, close tags are matched against them. A close tag of an
+        # enclosing section ends the sections within it, _closing holds it on its way up to its section.
+        self._open = []
+        self._closing = None
+        if recover and store is not None:
+            raise ValueError("recover can't be used with a store, files it shares are only parsed once so their "
+                             "diagnostics would be lost")
+
         # Start parsing and tracking nodes
         self.nodes = []
+
+        # Large configs can be split at the end of top level sections and the pieces parsed by worker processes. The
+        # tokens, nodes & lines are the same as those of a parse in this process.
+        if workers is not None and workers > 1 and len(data) > shard_size:
+            if profile is not None:
+                raise ValueError("workers can't be used with a profile, sections depend on the Defines before them")
+            if store is not None:
+                raise ValueError("workers can't be used with a store, its trees can't be shared between processes")
+            if limits is not None:
+                raise ValueError("workers can't be used with limits, the counts can't be shared between processes")
+            if recover:
+                raise ValueError("workers can't be used with recover, use a sequential parse to collect diagnostics")
+            if select is not None and not _picklable(select):
+                raise ValueError("workers can't be used with a select predicate that can't be pickled, e.g. a lambda, "
+                                 "use a set of names or a function defined at module level")
+            shards = _shards(data, shard_size)
+            if len(shards) > 1:
+                self._parse_shards(data, shards, workers, parent)
+                return
+
         node = self.parse(parent=parent)
         while node:
             self.nodes.append(node)
             node = self.parse(parent=parent)
 
     def parse(self, parent=None):
-        node = Node(parent=parent)
+        node = Node(parent=parent, weak_parent=self.weak_parents)
         # Flag that indicates we will be exiting a scoped directive after this
         # node completes building.
         for token in self._stream:
             token_class = token[0]
             token_data = token[1]
             if token_class is Token.Error:
-                raise ValueError("Config has errors, bailing.")
+                if not self.recover:
+                    raise ValueError("Config has errors, bailing.")
+                return self._error(node, token)
+            if self.skeleton:
+                if token_class is Token.Text.Whitespace or token_class is Token.Comment:
+                    self._line += token_data.count('\n')
+                    if node._pretokens and '\n' not in token_data:
+                        node.pretokens.append(_space)
+                    continue
+                if not node._pretokens:
+                    node._line = self._line
             node.pretokens.append(token)
 
             # Nodes don't have types until their first non-whitespace token is
@@ -55,10 +192,23 @@ class Parser:
                 # Complete reading the line for directives
                 for token in self._stream:
                     token_data = token[1]
+                    if token[0] is Token.Error:
+                        if not self.recover:
+                            raise ValueError("Config has errors, bailing.")
+                        return self._error(node, token)
+                    if self.skeleton:
+                        self._line += token_data.count('\n')
+                        if token[0] is Token.Text.Whitespace or token_data == '\\\n':
+                            if '\n' in token_data and '\\\n' not in token_data:
+                                break
+                            node.pretokens.append(_space)
+                            continue
                     node.pretokens.append(token)
                     if '\n' in token_data and '\\\n' not in token_data:
                         break
-                return self._nodefactory.build(node)
+                if self.select is not None and token_class is Token.Name.Builtin and not self._selected(node):
+                    return self._unparsed(node)
+                return self._build(node)
 
             # When handling Tag tokens, e.g. nested components, we need to
             # know if we're at the start OR end of the Tag. Check for '</'
@@ -70,27 +220,322 @@ class Parser:
             if token_class is Token.Name.Tag and token_data[0] == '>':
                 # If we're closing a tag it's time to return this node.
                 if node.closeTag:
-                    return self._nodefactory.build(node)
+                    if self.recover and node.type_token[1][2:].lower() not in self._open:
+                        return self._error_node(node, "{}> doesn't close an open section".format(
+                            node.type_token[1]))
+                    return self._build(node)
+
+                if self.select is not None and not self._selected(node):
+                    return self._unparsed(self._skip(node))
+
+                inactive = self.profile is not None and not self._inactive and not self.profile.evaluate(node)
+                if inactive and self.profile.prune:
+                    return self._build(self._skip(node))
 
                 # Otherwise, we're starting a Tag instead, begin building out
                 # the children nodes for this node.
+                self._inactive += inactive
+                if self.limits is not None:
+                    self.limits.enter_section()
+                name = node.type_token[1][1:].lower()
+                self._open.append(name)
                 child = self.parse(parent=node)
                 while child and child.closeTag is False:
                     node.children.append(child)
+                    if self._closing is not None:
+                        child, self._closing = self._closing, None
+                        break
                     child = self.parse(parent=node)
+                self._open.pop()
+                if self.limits is not None:
+                    self.limits.exit_section()
+                self._inactive -= inactive
 
                 # If the child was a </tag> node then migrate it's tokens into
                 # posttokens for this node.
-                if child and child.closeTag:
+                if child and child.closeTag and (not self.recover or child.type_token[1][2:].lower() == name):
                     for pt in child.tokens:
                         node.posttokens.append(pt)
-                return self._nodefactory.build(node)
+                elif self.recover:
+                    # Recovering parses end sections that aren't closed where their file or enclosing section ends,
+                    # the close tag of the enclosing section is handed on to it.
+                    self._closing = child
+                    built = self._build(node)
+                    self.diagnostics.append(Diagnostic(built, "{}> is never closed".format(built.type_token[1])))
+                    return built
+                return self._build(node)
         if len(node.tokens) > 0:
             # At the end of files we may sometimes have some white-space stragglers
             # this if block captures those into a new node.
             return node
         return None
 
+    def _build(self, node):
+        # Nodes built from here may need the parser's settings, e.g. Include hands them on to the files it loads.
+        node._parser = self
+        if self._inactive:
+            node._active = False
+        if self.limits is not None:
+            self.limits.node()
+        built = self._nodefactory.build(node)
+        del node._parser
+        built.__dict__.pop('_parser', None)
+        if self.profile is not None and built.active:
+            self.profile.observe(built)
+        if isinstance(built, ServerRoot) and built.active:
+            self.resolver.observe(built)
+        return built
+
+    def _skip(self, node):
+        """
+        Consumes the tokens of an opened section up to & including its matching close tag without building nodes.
+        The consumed body is kept as a single Unparsed child so that the section still renders to the original text.
+        Selective parses find the close tag with _close_tag and keep the body's text as one token without lexing it.
+        :return: The section node.
+        """
+        tokens = []
+        close = self._close_tag() if self._tags is not None else None
+        if close is not None:
+            text = self._data[self._offset:close]
+            if text:
+                tokens.append((Token.Text, text))
+            if self.skeleton:
+                self._line += text.count('\n')
+            self._seek = close
+        depth = 0
+        for token in self._stream:
+            if token[0] is Token.Error and not self.recover:
+                raise ValueError("Config has errors, bailing.")
+            if self.skeleton:
+                self._line += token[1].count('\n')
+            if token[0] is Token.Name.Tag and token[1][0] == '<':
+                if token[1][1] != '/':
+                    depth += 1
+                elif depth:
+                    depth -= 1
+                else:
+                    node.posttokens.append(token)
+                    for token in self._stream:
+                        node.posttokens.append(token)
+                        if token[0] is Token.Name.Tag:
+                            break
+                    break
+            tokens.append(token)
+        if tokens:
+            unparsed = Unparsed(parent=node, weak_parent=self.weak_parents)
+            unparsed._pretokens = tokens
+            node.children.append(unparsed)
+        return node
+
+    def _lex(self, data, acl):
+        """
+        Lexes data a piece at a time, pieces end where close tags start since that's where _skip resumes lexing.
+        :return: Generator of tokens, like pygments.lex.
+        """
+        starts, closing = self._tags
+        closes = [start for start, close in zip(starts, closing) if close]
+        position = 0
+        length = len(data)
+        while position < length:
+            index = bisect.bisect_right(closes, position)
+            end = closes[index] if index < len(closes) else length
+            self._offset = position
+            for token in pygments.lex(data[position:end], acl):
+                self._offset += len(token[1])
+                yield token
+                if self._seek is not None:
+                    break
+            if self._seek is not None:
+                end, self._seek = self._seek, None
+            position = end
+
+    def _close_tag(self):
+        """
+        Finds the close tag of the section whose open tag was just lexed among the lines of data that open or close
+        sections, without lexing the body.
+        :return: Offset of the close tag, the length of data when there's none and None when the rest of the open
+                 tag's line holds more than a comment, e.g. the close tag itself.
+        """
+        data = self._data
+        offset = self._offset
+        end = data.find('\n', offset)
+        rest = data[offset:end if end != -1 else len(data)].strip()
+        if rest and rest[0] != '#':
+            return None
+        starts, closing = self._tags
+        depth = 0
+        for index in range(bisect.bisect_left(starts, offset), len(starts)):
+            if not closing[index]:
+                depth += 1
+            elif depth:
+                depth -= 1
+            else:
+                return starts[index]
+        return len(data)
+
+    def _error(self, node, token):
+        """
+        Consumes the rest of the line token is on.
+        :return: ErrorNode holding node's tokens and the rest of the line.
+        """
+        if self.skeleton and node._line is None:
+            node._line = self._line
+        node.pretokens.append(token)
+        if '\n' not in token[1]:
+            for token in self._stream:
+                node.pretokens.append(token)
+                if self.skeleton:
+                    self._line += token[1].count('\n')
+                if '\n' in token[1] and '\\\n' not in token[1]:
+                    break
+        return self._error_node(node, "can't parse {!r}".format(''.join(token[1] for token in node._pretokens).strip()))
+
+    def _error_node(self, node, message):
+        """
+        :return: ErrorNode holding node's tokens, reported in diagnostics with message.
+        """
+        error = ErrorNode(parent=node._parent, weak_parent=self.weak_parents)
+        error._pretokens = node._pretokens
+        error._line = node._line
+        if self._inactive:
+            error._active = False
+        self.diagnostics.append(Diagnostic(error, message))
+        return error
+
+    def _selected(self, node):
+        name = node.type_token[1].lstrip('<').lower()
+        return name in _always_selected or self.select(name)
+
+    def _unparsed(self, node):
+        """
+        :return: Unparsed node holding all of node's tokens, used in place of directives & sections not selected.
+        """
+        unparsed = Unparsed(parent=node._parent, weak_parent=self.weak_parents)
+        unparsed._pretokens = node.tokens
+        if self._inactive:
+            unparsed._active = False
+        return unparsed
+
+    def _parse_shards(self, data, shards, workers, parent):
+        from concurrent.futures import ProcessPoolExecutor
+        options = {'nodefactory': self._nodefactory, 'acl': self._acl, 'skeleton': self.skeleton,
+                   'weak_parents': self.weak_parents, 'select': self.select}
+        jobs = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for start, end, line, server_root in shards:
+                resolver = self.resolver
+                # ServerRoot directives of earlier shards apply to the Includes of later ones.
+                if server_root is not None and not resolver._pinned:
+                    resolver = Resolver()
+                    resolver.server_root = server_root
+                jobs.append(executor.submit(_parse_shard, data[start:end], line, dict(options, resolver=resolver)))
+            for job in jobs:
+                for node in job.result():
+                    node._parent = parent
+                    self.nodes.append(node)
+
+    def _include_options(self):
+        """
+        :return: Keyword arguments used to parse the files loaded by Include directives found by this parser.
+        """
+        return {'profile': self.profile, 'resolver': self.resolver, 'skeleton': self.skeleton,
+                'weak_parents': self.weak_parents, 'select': self.select, 'store': self.store,
+                'limits': self.limits, 'recover': self.recover, 'diagnostics': self.diagnostics}
+
+
+def _lines(data):
+    """
+    Scans data line by line without lexing it. Lines continued with a backslash or inside quotes belong to the line
+    they continue and aren't yielded, nor are blank lines.
+    :return: Generator of (start, end, line number, stripped text) tuples.
+    """
+    line = 1
+    continued = quoted = False
+    position = 0
+    length = len(data)
+    while position < length:
+        end = data.find('\n', position)
+        if end == -1:
+            end = length
+        text = data[position:end].strip()
+        if text and not continued and not quoted:
+            yield position, end, line, text
+        if text[:1] != '#' and (text.count('"') - text.count('\\"')) % 2:
+            quoted = not quoted
+        continued = text.endswith('\\')
+        position = end + 1
+        line += 1
+
+
+def _tag_lines(data):
+    """
+    :return: (offsets, closing) lists of the lines of data that open or close sections, offsets are those of their
+             '<' and closing tells close tags apart.
+    """
+    starts = []
+    closing = []
+    for position, end, line, text in _lines(data):
+        if text[0] == '<':
+            starts.append(data.index('<', position))
+            closing.append(text[1:2] == '/')
+    return starts, closing
+
+
+def _shards(data, shard_size):
+    """
+    Finds where data can be split into pieces of about shard_size characters that lex & parse the same on their own:
+    right after the close tag of a top level section, where the lexer is back in its initial state and the whitespace
+    that follows belongs to the next node. Lines continued with a backslash or inside quotes are never split at.
+    :return: List of (start, end, first line, ServerRoot before start) tuples.
+    """
+    shards = []
+    start = 0
+    start_line = 1
+    start_root = server_root = None
+    depth = 0
+    length = len(data)
+    for position, end, line, text in _lines(data):
+        if text[0] == '<' and text[1:2] == '/':
+            depth = max(depth - 1, 0)
+            split = position + len(data[position:end].rstrip())
+            if not depth and text[-1] == '>' and split - start >= shard_size:
+                shards.append((start, split, start_line, start_root))
+                start, start_line, start_root = split, line, server_root
+        elif text[0] == '<':
+            depth += 1
+        elif text[:10].lower() == 'serverroot' and text[10:11].isspace():
+            arguments = _argument_re.findall(text)
+            if len(arguments) > 1:
+                server_root = arguments[1].strip('"')
+    if start < length or not shards:
+        shards.append((start, length, start_line, start_root))
+    return shards
+
+
+def _picklable(value):
+    try:
+        pickle.dumps(value)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+    return True
+
+
+def _parse_shard(data, first_line, options):
+    # Runs in the worker processes of Parser, the nodes are pickled back.
+    nodes = Parser(data, **options).nodes
+    if options['skeleton'] and first_line > 1:
+        _shift_lines(nodes, first_line - 1)
+    return nodes
+
+
+def _shift_lines(nodes, offset):
+    for node in nodes:
+        if node._line is not None:
+            node._line += offset
+        # Included files have lines of their own.
+        if not isinstance(node, Include):
+            _shift_lines(node._children, offset)
+
 
 class DefaultFactory(NodeFactory):
     def __init__(self):
@@ -106,6 +551,12 @@ class DefaultFactory(NodeFactory):
             node = Comment(node=node)
 
         if isinstance(node, ScopedDirective):
+            if node.name.lower() == 'ifmodule':
+                node = IfModule(node=node)
+            if node.name.lower() == 'ifdefine':
+                node = IfDefine(node=node)
+            if node.name.lower() == 'if':
+                node = If(node=node)
             if node.name.lower() == 'virtualhost':
                 node = VirtualHost(node=node)
             if node.name.lower() == 'directory':
@@ -133,10 +584,16 @@ class DefaultFactory(NodeFactory):
                 node = Include(node=node)
             elif node.name.lower() == 'includeoptional':
                 node = IncludeOptional(node=node)
+            elif node.name.lower() == 'define':
+                node = Define(node=node)
+            elif node.name.lower() == 'serverroot':
+                node = ServerRoot(node=node)
 
-        # Fix up children's parent.
-        for child in node.children:
-            child._parent = node
+        # Fix up children's parent. Include sets the parents of the files it loads, those may be shared, see
+        # InternStore.
+        if not isinstance(node, Include):
+            for child in node.children:
+                child._parent = node
 
         return node
 
@@ -153,12 +610,17 @@ class Directive(Node):
         example: 'ServerName example.com' returns [u'example.com']
         example: 'Deny from all' returns [u'from', u'all']
         """
-        args = []
         directiveIndex = self._pretokens.index(self.type_token)
+        text = []
         for token in self._pretokens[directiveIndex+1:]:
-            if token[0] is Token.Text or token[0] is Token.Literal.String:
-                args.append(token[1].strip())
-        return args
+            if token[0] is Token.Name.Tag:
+                break
+            if token[1] == '\\\n':
+                # Line continuations separate arguments just like whitespace does.
+                text.append(' ')
+                continue
+            text.append(token[1])
+        return _argument_re.findall(''.join(text))
 
 
 class ScopedDirective(Directive):
@@ -171,19 +633,100 @@ class Comment(Node):
     pass
 
 
+class Unparsed(Node):
+    """
+    Holds the raw tokens of a section body that was skipped instead of being parsed into nodes.
+    """
+    @property
+    def type_token(self):
+        return None
+
+
+class ErrorNode(Unparsed):
+    """
+    Holds the original text of a line that couldn't be parsed, see Parser's recover option.
+    """
+    @property
+    def type_token(self):
+        # The line's first token, so the node is located at the line rather than after it.
+        for token in self._pretokens:
+            if token[0] is not Token.Text.Whitespace:
+                return token
+        return None
+
+
+class Diagnostic:
+    """
+    A problem found by a recovering parse. file & line are looked up once the tree is complete.
+    """
+    def __init__(self, node, message):
+        self.node = node
+        self.message = message
+
+    @property
+    def location(self):
+        """
+        :return: (file, line) tuple of the node the problem was found at.
+        """
+        from .utilities import locate
+        return locate(self.node)
+
+    @property
+    def file(self):
+        return self.location[0]
+
+    @property
+    def line(self):
+        return self.location[1]
+
+    def __str__(self):
+        file, line = self.location
+        return "{}:{}: {}".format(file, line, self.message)
+
+    def __repr__(self):
+        return "<Diagnostic {}>".format(self)
+
+
 class ConfigFile(Node):
-    def __init__(self, node=None, file=None):
-        Node.__init__(self, node=node)
+    def __init__(self, node=None, file=None, data=None, **options):
+        """
+        :param file: Path of the config file to load & parse.
+        :param data: Text of the file when it was already read, file is then only used as its name.
+        :param options: Additional keyword arguments for the Parser, e.g. profile.
+        """
+        Node.__init__(self, node=node, weak_parent=options.get('weak_parents', False))
+        if file and options.get('resolver') is not None:
+            file = options['resolver'].resolve(file)
         self._file = file
+        self._skeleton = bool(file and options.get('skeleton'))
+        if file and options.get('limits') is not None:
+            options['limits'].open(file)
         if file:
-            with open(file, "r") as f:
-                data = f.read()
-            self._parser = Parser(data, parent=self)
+            if data is None:
+                with open(file, "r") as f:
+                    data = f.read()
+            self._parser = Parser(data, parent=self, **options)
             self._children = self._parser.nodes
 
+    @property
+    def diagnostics(self):
+        """
+        :return: List of the Diagnostics of a recovering parse of this file and the files it includes.
+        """
+        return self._parser.diagnostics if self._parser is not None else []
+
+    @property
+    def roundtrip(self):
+        """
+        :return: False when the file was parsed as a skeleton, str() then no longer reproduces the original file.
+        """
+        return not self._skeleton
+
     def write(self):
-        with open(self._file, "w") as self.__fh:
-            self.__fh.write(str(self))
+        if not self.roundtrip:
+            raise ValueError("Skeleton configs can't be written, they don't hold the original text.")
+        with open(self._file, "w") as f:
+            self.render_to(f)
 
 
 class VirtualHost(ScopedDirective):
@@ -201,30 +744,27 @@ class VirtualHost(ScopedDirective):
 
 
 class ServerName(Directive):
+    # The lint rule behind isValid, shared by every ServerName. lint imports this module, so it's created on first use.
+    _rule = None
+
     @property
     def isValid(self):
-        if len(self.arguments) != 1:
-            return False
-
-        regex = '^((?P<scheme>[a-zA-Z]+)(://))?(?P<domain>[a-zA-Z_0-9.]+)(:(?P<port>[0-9]+))?\\s*$'
-        match = re.search(regex, self.arguments[0])
-        if match:
-            return True
-        return False
+        if ServerName._rule is None:
+            from .lint import ServerNameRule
+            ServerName._rule = ServerNameRule()
+        return not ServerName._rule.check(self)
 
 
 class ServerAlias(Directive):
+    # The lint rule behind isValid, shared by every ServerAlias. lint imports this module, so it's created on first use.
+    _rule = None
+
     @property
     def isValid(self):
-        if len(self.arguments) == 0:
-            return False
-
-        regex = '^(?P<domain>[a-zA-Z_0-9.]+)\\s*$'
-        for name in self.arguments:
-            match = re.search(regex, name)
-            if not match:
-                return False
-        return True
+        if ServerAlias._rule is None:
+            from .lint import ServerAliasRule
+            ServerAlias._rule = ServerAliasRule()
+        return not ServerAlias._rule.check(self)
 
 
 class IncludeError(Exception):
@@ -232,26 +772,75 @@ class IncludeError(Exception):
 
 
 class Include(Directive):
+    # Paths of the files loaded, in the order of the children.
+    _paths = None
+
     def __init__(self, node=None):
         Node.__init__(self, node=node)
+        options = self._parser._include_options() if self._parser else {}
+        recover = options.get('recover')
         if not self.path:
+            if recover:
+                options['diagnostics'].append(Diagnostic(self, "{} without a path".format(self.name)))
+                return
             raise IncludeError("path cannot be none")
-        if len(glob.glob(self.path)) == 0:
-            raise ValueError("Include directive failed to include '{}'".format(self.path))
-        for path in glob.glob(self.path):
-            cf = ConfigFile(file=path)
-            cf._parent = self
+        # Includes inside inactive conditional sections are never loaded by Apache, don't load them either.
+        if not self.active:
+            return
+        pattern = self.path
+        if options.get('profile') is not None:
+            pattern = options['profile'].expand(pattern)
+        resolver = options.get('resolver') or Resolver()
+        limits = options.get('limits')
+        paths = resolver.glob(pattern, limit=limits.max_fanout if limits is not None else None, limits=limits)
+        if len(paths) == 0:
+            if recover and not isinstance(self, IncludeOptional):
+                options['diagnostics'].append(Diagnostic(self, "{} '{}' matched no files".format(self.name, pattern)))
+                return
+            raise ValueError("Include directive failed to include '{}'".format(pattern))
+        self._paths = []
+        if limits is not None:
+            limits.enter_include(len(paths))
+        store = options.get('store')
+        for path in paths:
+            if store is not None:
+                # Shared with other trees, see ParentIndex for the Include that loaded it in this one.
+                cf = store.load(path, **options)
+            else:
+                try:
+                    cf = ConfigFile(file=path, **options)
+                except OSError as e:
+                    if not recover:
+                        raise
+                    options['diagnostics'].append(Diagnostic(self, "can't read '{}': {}".format(path, e.strerror)))
+                    continue
+                cf._parent = self
+            self._paths.append(path)
             self._children.append(cf)
+        if limits is not None:
+            limits.exit_include()
 
     @property
     def path(self):
         """
         :return: The glob pattern used to load additional configs.
         """
+        from .utilities import unquote
         if len(self.arguments) > 0:
-            return self.arguments[0].strip()
+            return unquote(self.arguments[0])
         return None
 
+    @property
+    def newlines(self):
+        # Included files aren't rendered into the including file.
+        if self._newlines is None:
+            self._newlines = sum(token[1].count('\n') for token in self._pretokens)
+        return self._newlines
+
+    def _texts(self):
+        for token in self._pretokens:
+            yield token[1]
+
     @property
     def tokens(self):
         """
@@ -303,3 +892,23 @@ class Proxy(ScopedDirective):
 
 class ProxyMatch(ScopedDirective):
     pass
+
+
+class IfModule(ScopedDirective):
+    pass
+
+
+class IfDefine(ScopedDirective):
+    pass
+
+
+class If(ScopedDirective):
+    pass
+
+
+class Define(Directive):
+    pass
+
+
+class ServerRoot(Directive):
+    pass
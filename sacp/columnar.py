@@ -0,0 +1,198 @@
+from .base import *
+from array import array
+from bisect import bisect_right
+
+# NumPy takes longer to import than sacp itself, it's imported when the first columns are built. False until then.
+_numpy = False
+
+
+def _import_numpy():
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+
+class TokenColumns:
+    """
+    Columnar copy of the tokens of a tree, in render order, for fast read-only scans of very large configs.
+
+    Instead of one tuple per token the columns hold a token type id, the start & end offsets of the token's text in
+    one shared string and the id of the node owning the token. Nodes get an id in pre-order along with the id of
+    their lower case name. Scans such as counting lines, finding all tokens of a type or all nodes with one of a set
+    of names run as vectorized NumPy operations when NumPy is installed and as loops over the arrays otherwise.
+
+    Like Node.tokens the columns don't include the files loaded by Include directives, build columns for those
+    ConfigFiles separately. The columns are a snapshot, see stale.
+
+    Example:
+    columns = TokenColumns(ConfigFile(file="conf/httpd.conf"))
+    vhosts = [columns.nodes[i] for i in columns.nodes_named(['VirtualHost'])]
+    """
+    def __init__(self, root, use_numpy=None):
+        """
+        :param root: Node whose tokens are stored, usually a ConfigFile.
+        :param use_numpy: Force (True) or avoid (False) NumPy, by default it is used when installed.
+        """
+        numpy = _import_numpy() if use_numpy is not False else None
+        if use_numpy and numpy is None:
+            raise ValueError("use_numpy requires numpy to be installed")
+        self._numpy = numpy
+        self._root = root
+        self._revision = root.revision
+        self.token_types = []
+        self.names = []
+        self.nodes = []
+        type_ids = {}
+        name_ids = {}
+        types = array('H')
+        starts = array('q')
+        ends = array('q')
+        owners = array('l')
+        node_names = array('l')
+        type_indexes = array('q')
+        pieces = []
+        offset = 0
+
+        def add(node):
+            node_id = len(self.nodes)
+            self.nodes.append(node)
+            name = -1
+            if isinstance(node, Directive):
+                lower = node.name.lower()
+                name = name_ids.get(lower)
+                if name is None:
+                    name = name_ids[lower] = len(self.names)
+                    self.names.append(lower)
+            node_names.append(name)
+            type_token = node.type_token
+            type_indexes.append(-1)
+            for token in node._pretokens:
+                if token is type_token:
+                    type_indexes[node_id] = len(types)
+                append(token, node_id)
+            # Included files aren't rendered into the including file.
+            if not isinstance(node, Include):
+                for child in node._children:
+                    add(child)
+            for token in node._posttokens:
+                append(token, node_id)
+
+        def append(token, node_id):
+            nonlocal offset
+            type_id = type_ids.get(token[0])
+            if type_id is None:
+                type_id = type_ids[token[0]] = len(self.token_types)
+                self.token_types.append(token[0])
+            types.append(type_id)
+            starts.append(offset)
+            offset += len(token[1])
+            ends.append(offset)
+            owners.append(node_id)
+            pieces.append(token[1])
+
+        add(root)
+        self.text = ''.join(pieces)
+        self.types = types
+        self.starts = starts
+        self.ends = ends
+        self.owners = owners
+        self.node_names = node_names
+        self.type_indexes = type_indexes
+        self._newlines = None
+        if numpy:
+            self.types = numpy.frombuffer(types, dtype=numpy.uint16)
+            self.starts = numpy.frombuffer(starts, dtype=numpy.int64)
+            self.ends = numpy.frombuffer(ends, dtype=numpy.int64)
+            self.owners = numpy.frombuffer(owners, dtype=numpy.dtype(owners.typecode))
+            self.node_names = numpy.frombuffer(node_names, dtype=numpy.dtype(node_names.typecode))
+            self.type_indexes = numpy.frombuffer(type_indexes, dtype=numpy.int64)
+
+    @property
+    def stale(self):
+        """
+        :return: True when the tree changed since the columns were built.
+        """
+        return self._root.revision != self._revision
+
+    def __len__(self):
+        return len(self.types)
+
+    def token(self, index):
+        """
+        :return: The (type, text) tuple of the token at index.
+        """
+        return self.token_types[self.types[index]], self.text[self.starts[index]:self.ends[index]]
+
+    def newline_offsets(self):
+        """
+        :return: Sorted offsets of every newline in the text.
+        """
+        if self._newlines is None:
+            if self._numpy:
+                numpy = self._numpy
+                codes = numpy.frombuffer(self.text.encode('utf-32-le'), dtype=numpy.uint32)
+                self._newlines = numpy.flatnonzero(codes == 10)
+            else:
+                newlines = array('q')
+                find = self.text.find
+                index = find('\n')
+                while index != -1:
+                    newlines.append(index)
+                    index = find('\n', index + 1)
+                self._newlines = newlines
+        return self._newlines
+
+    def token_lines(self, indexes=None):
+        """
+        :param indexes: Token indexes, all tokens when None.
+        :return: Line number each token starts on.
+        """
+        newlines = self.newline_offsets()
+        if self._numpy:
+            numpy = self._numpy
+            starts = self.starts if indexes is None else self.starts[numpy.asarray(indexes, dtype=numpy.int64)]
+            return numpy.searchsorted(newlines, starts, side='left') + 1
+        starts = self.starts if indexes is None else [self.starts[i] for i in indexes]
+        return [bisect_right(newlines, start - 1) + 1 for start in starts]
+
+    def lines(self):
+        """
+        :return: List of (node, line) tuples for every node with a type, like LineEnumerator.lines.
+        """
+        if self._numpy:
+            typed = self._numpy.flatnonzero(self.type_indexes >= 0)
+            lines = self.token_lines(self.type_indexes[typed])
+            return [(self.nodes[i], int(line)) for i, line in zip(typed.tolist(), lines.tolist())]
+        typed = [i for i, index in enumerate(self.type_indexes) if index >= 0]
+        lines = self.token_lines([self.type_indexes[i] for i in typed])
+        return [(self.nodes[i], line) for i, line in zip(typed, lines)]
+
+    def tokens_of_type(self, token_type):
+        """
+        :param token_type: Pygments token type, subtypes match as well, e.g. Token.Text matches Token.Text.Whitespace.
+        :return: Indexes of the matching tokens.
+        """
+        ids = [i for i, t in enumerate(self.token_types) if t in token_type]
+        if self._numpy:
+            numpy = self._numpy
+            return numpy.flatnonzero(numpy.isin(self.types, ids))
+        ids = set(ids)
+        return [i for i, t in enumerate(self.types) if t in ids]
+
+    def nodes_named(self, names):
+        """
+        :param names: Directive or section names, case insensitive.
+        :return: Ids of the nodes with one of the names, in tree order. self.nodes maps ids to nodes.
+        """
+        wanted = set(name.lower() for name in names)
+        ids = [i for i, name in enumerate(self.names) if name in wanted]
+        if self._numpy:
+            numpy = self._numpy
+            return numpy.flatnonzero(numpy.isin(self.node_names, ids))
+        ids = set(ids)
+        return [i for i, name in enumerate(self.node_names) if name in ids]
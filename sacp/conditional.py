@@ -0,0 +1,115 @@
+from .base import *
+import re
+
+
+_variable_re = re.compile(r'\$\{([^}]+)\}')
+
+
+def module_name(name):
+    """
+    Normalizes the different ways a module can be named, e.g. 'mod_ssl.c', 'ssl_module' and 'mod_ssl' are all 'ssl'.
+    """
+    name = name.strip('"\'').lower()
+    if name.endswith('.c'):
+        name = name[:-2]
+    if name.endswith('_module'):
+        name = name[:-7]
+    if name.startswith('mod_'):
+        name = name[4:]
+    return name
+
+
+class ServerProfile:
+    """
+    Describes the server a config is evaluated for: which modules are loaded and which names are defined (e.g. with
+    'httpd -D NAME' or the Define directive). Passing a profile to the Parser or ConfigFile evaluates <IfModule> and
+    <IfDefine> sections while parsing; <If> expressions are evaluated at request time and are always treated as
+    active.
+
+    The profile follows the config as it is parsed, LoadModule adds to the loaded modules while Define & UnDefine
+    change the defined names, so use a fresh profile for each parse.
+
+    Example:
+    profile = ServerProfile(modules=['mod_ssl.c'], defines={'PROD': None})
+    cf = ConfigFile(file="conf/httpd.conf", profile=profile)
+    """
+    def __init__(self, modules=None, defines=None, prune=False):
+        """
+        :param modules: Iterable of loaded module names, any of 'mod_ssl.c', 'ssl_module' or 'ssl'.
+        :param defines: Dictionary of defined names to their values (None for names defined without a value), or an
+                        iterable of defined names.
+        :param prune: When True the bodies of inactive sections are skipped rather than built into inactive nodes.
+        """
+        self.modules = set(module_name(module) for module in modules or ())
+        if defines is None:
+            defines = {}
+        if not isinstance(defines, dict):
+            defines = dict.fromkeys(defines)
+        self.defines = dict(defines)
+        self.prune = prune
+        self._expanded = {}
+
+    def define(self, name, value=None):
+        self.defines[name] = value
+        self._expanded.clear()
+
+    def undefine(self, name):
+        self.defines.pop(name, None)
+        self._expanded.clear()
+
+    def expand(self, text):
+        """
+        :return: text with each ${NAME} replaced by the value of the defined name, unknown names are left untouched.
+        """
+        if '${' not in text:
+            return text
+        expanded = self._expanded.get(text)
+        if expanded is None:
+            expanded = _variable_re.sub(self._substitute, text)
+            self._expanded[text] = expanded
+        return expanded
+
+    def _substitute(self, match):
+        value = self.defines.get(match.group(1), match.group(0))
+        return match.group(0) if value is None else value
+
+    def evaluate(self, node):
+        """
+        :param node: Section node, only <IfModule> & <IfDefine> are evaluated.
+        :return: False when the children of the section are inactive for this profile.
+        """
+        section = ScopedDirective(node=node)
+        name = section.name.lower()
+        if name != 'ifmodule' and name != 'ifdefine':
+            return True
+        arguments = section.arguments
+        if not arguments:
+            return True
+        argument = self.expand(arguments[0].strip('"\''))
+        negate = argument.startswith('!')
+        if negate:
+            argument = argument[1:]
+        if name == 'ifmodule':
+            found = module_name(argument) in self.modules
+        else:
+            found = argument in self.defines
+        return found != negate
+
+    def observe(self, node):
+        """
+        Updates the profile from an active node as it is built, e.g. Define, UnDefine and LoadModule.
+        """
+        if not isinstance(node, Directive) or isinstance(node, ScopedDirective):
+            return
+        name = node.name.lower()
+        if name not in ('define', 'undefine', 'loadmodule'):
+            return
+        arguments = [self.expand(argument.strip('"')) for argument in node.arguments]
+        if not arguments:
+            return
+        if name == 'define':
+            self.define(arguments[0], arguments[1] if len(arguments) > 1 else None)
+        elif name == 'undefine':
+            self.undefine(arguments[0])
+        else:
+            self.modules.add(module_name(arguments[0]))
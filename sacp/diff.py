@@ -0,0 +1,91 @@
+from .base import *
+from .utilities import *
+
+
+class Change:
+    """
+    A single difference between two trees.
+
+    kind is one of 'inserted', 'removed' or 'modified'. Removed changes only have a left node, inserted changes only
+    have a right node. Locations are those of the right node, or the left node for removals.
+    """
+    def __init__(self, kind, left=None, right=None):
+        self.kind = kind
+        self.left = left
+        self.right = right
+
+    @property
+    def node(self):
+        return self.right if self.right is not None else self.left
+
+    @property
+    def location(self):
+        """
+        :return: (file, line) tuple of the changed node.
+        """
+        return locate(self.node)
+
+    def __repr__(self):
+        file, line = self.location
+        return "<Change {} {}:{} {!r}>".format(self.kind, file, line, str(self.node).strip())
+
+
+def diff(left, right):
+    """
+    Structurally compares two trees, e.g. a staged ConfigFile against the one in production. Subtrees with identical
+    content hashes are skipped without being walked, so the cost grows with the size of the changes rather than the
+    size of the trees.
+    :return: List of Changes in tree order.
+    """
+    changes = []
+    _diff_node(left, right, changes)
+    return changes
+
+
+def _key(node):
+    if isinstance(node, ConfigFile):
+        return ConfigFile, node._file
+    if isinstance(node, Directive):
+        return type(node), node.name.lower()
+    return type(node), None
+
+
+def _reported(node):
+    # Whitespace only nodes aren't worth reporting on their own.
+    return node.type_token is not None or node.children or isinstance(node, Unparsed)
+
+
+def _diff_node(left, right, changes):
+    if left.content_hash == right.content_hash:
+        return
+    if left._pretokens != right._pretokens or left._posttokens != right._posttokens:
+        changes.append(Change('modified', left, right))
+    _diff_children(left.children, right.children, changes)
+
+
+def _diff_children(left, right, changes):
+    import difflib
+    matcher = difflib.SequenceMatcher(None, [node.content_hash for node in left],
+                                      [node.content_hash for node in right], autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        # Pair up nodes of the same kind, e.g. a directive whose arguments changed, and compare them in depth.
+        inserted = list(right[j1:j2])
+        paired = {}
+        for node in left[i1:i2]:
+            key = _key(node)
+            for other in inserted:
+                if _key(other) == key:
+                    paired[id(other)] = node
+                    inserted.remove(other)
+                    break
+            else:
+                if _reported(node):
+                    changes.append(Change('removed', left=node))
+        for other in right[j1:j2]:
+            node = paired.get(id(other))
+            if node is not None:
+                _diff_node(node, other, changes)
+            elif _reported(other):
+                changes.append(Change('inserted', right=other))
@@ -0,0 +1,135 @@
+from .base import *
+from .utilities import *
+
+
+# Directives that may be given several times, each occurrence adds to the configuration rather than replacing it.
+MULTI_VALUED = frozenset([
+    'addtype', 'addhandler', 'addoutputfilter', 'addencoding', 'addlanguage', 'addcharset', 'alias', 'aliasmatch',
+    'customlog', 'errordocument', 'header', 'listen', 'loadmodule', 'logformat', 'protocols', 'proxypass',
+    'proxypassmatch', 'proxypassreverse', 'proxypassreversecookiedomain', 'proxypassreversecookiepath', 'redirect',
+    'redirectmatch', 'redirectpermanent', 'redirecttemp', 'requestheader', 'scriptalias', 'scriptaliasmatch',
+    'serveralias', 'setenv', 'setenvif', 'setenvifnocase', 'unsetenv',
+])
+
+# Directives a virtual host does not inherit from the main server, e.g. mod_rewrite configurations are not inherited
+# unless RewriteOptions Inherit is used.
+NOT_INHERITED = frozenset(['rewriteengine', 'rewritecond', 'rewriterule', 'rewritemap', 'rewriteoptions'])
+
+
+class ScopeConfig:
+    """
+    The directives in effect for one context, keyed by lower case directive name in config order.
+    """
+    def __init__(self, directives=None):
+        self._directives = directives or {}
+
+    def get(self, name):
+        """
+        :return: The Directive that takes effect for name, e.g. the last DocumentRoot, or None.
+        """
+        directives = self._directives.get(name.lower())
+        if directives:
+            return directives[-1]
+        return None
+
+    def get_all(self, name):
+        """
+        :return: List of every Directive in effect for name, e.g. all ServerAlias directives.
+        """
+        return list(self._directives.get(name.lower(), ()))
+
+    def arguments(self, name):
+        """
+        :return: Arguments of the Directive that takes effect for name, or None.
+        """
+        directive = self.get(name)
+        if directive is None:
+            return None
+        return directive.arguments
+
+    def names(self):
+        return list(self._directives)
+
+    def __contains__(self, name):
+        return name.lower() in self._directives
+
+
+class EffectiveConfig:
+    """
+    Resolves the configuration in effect for the main server and each virtual host of a tree. A virtual host starts
+    from the main server's directives and its own directives override them, directives listed in MULTI_VALUED add to
+    the server's instead and those in NOT_INHERITED are not inherited at all.
+
+    Results are memoized and recomputed once the tree's revision changes, see Node.invalidate.
+
+    Example:
+    ec = EffectiveConfig(ConfigFile(file="conf/httpd.conf", profile=ServerProfile(modules=['ssl'])))
+    for vhost in ec.virtual_hosts:
+        print(vhost.arguments, ec.vhost(vhost).arguments('DocumentRoot'))
+    """
+    def __init__(self, root):
+        self._root = root
+        self._revision = None
+        self._server = None
+        self._virtual_hosts = None
+        self._vhosts = {}
+
+    def _refresh(self):
+        revision = self._root.revision
+        if revision == self._revision:
+            return
+        self._revision = revision
+        self._vhosts = {}
+        self._virtual_hosts = []
+        directives = {}
+        for node in iter_scope([self._root]):
+            if isinstance(node, VirtualHost):
+                self._virtual_hosts.append(node)
+            elif isinstance(node, Directive) and not isinstance(node, ScopedDirective):
+                directives.setdefault(node.name.lower(), []).append(node)
+        self._server = ScopeConfig(directives)
+
+    @property
+    def server(self):
+        """
+        :return: ScopeConfig for the main server.
+        """
+        self._refresh()
+        return self._server
+
+    @property
+    def virtual_hosts(self):
+        """
+        :return: List of the VirtualHost sections in the main server's context.
+        """
+        self._refresh()
+        return list(self._virtual_hosts)
+
+    def vhost(self, vhost):
+        """
+        :param vhost: VirtualHost node from the tree.
+        :return: ScopeConfig with the directives in effect for the virtual host.
+        """
+        self._refresh()
+        config = self._vhosts.get(vhost)
+        if config is None:
+            config = ScopeConfig(self._merge(vhost))
+            self._vhosts[vhost] = config
+        return config
+
+    def _merge(self, vhost):
+        overrides = {}
+        for node in iter_scope(vhost.children):
+            if isinstance(node, Directive) and not isinstance(node, ScopedDirective):
+                overrides.setdefault(node.name.lower(), []).append(node)
+
+        directives = {}
+        for name, nodes in self._server._directives.items():
+            if name not in NOT_INHERITED:
+                directives[name] = nodes
+        for name, nodes in overrides.items():
+            if name in MULTI_VALUED and name in directives:
+                directives[name] = directives[name] + nodes
+            else:
+                directives[name] = nodes
+        return directives
@@ -0,0 +1,192 @@
+from .base import *
+from .utilities import *
+import hashlib
+
+
+_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    server TEXT NOT NULL,
+    path TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    include_id INTEGER,
+    UNIQUE (server, path)
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    server TEXT NOT NULL,
+    class TEXT NOT NULL,
+    name TEXT NOT NULL COLLATE NOCASE,
+    arguments TEXT NOT NULL,
+    parent_id INTEGER,
+    line INTEGER NOT NULL,
+    active INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS arguments (
+    node_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS nodes_name ON nodes (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS nodes_arguments ON nodes (arguments);
+CREATE INDEX IF NOT EXISTS nodes_file ON nodes (file_id, position);
+CREATE INDEX IF NOT EXISTS arguments_value ON arguments (value);
+CREATE INDEX IF NOT EXISTS arguments_node ON arguments (node_id);
+"""
+
+
+class SQLiteIndex:
+    """
+    Index of parsed trees in a SQLite database, so questions about many servers' configs become indexed queries
+    rather than parses.
+
+    Every Directive and section is a row of the nodes table holding its class, name, arguments (joined by single
+    spaces), parent's id, file, line and server, each argument is also a row of the arguments table. Every file is a
+    row of the files table, included files point at the Include node that loaded them through include_id.
+
+    Exports are incremental: files are keyed on a hash of their text and the nodes of files whose text didn't change
+    since the last export of the same server are kept as they are, the rows of files the server no longer includes are
+    removed. The hash covers the text only, re-export after forget() when the parse options that shape the tree, e.g.
+    the ServerProfile, change.
+
+    Example:
+    with SQLiteIndex('configs.db') as index:
+        for server, path in servers:
+            index.export(ConfigFile(file=path), server)
+        rows = index.find('SSLProtocol', argument='TLSv1')
+    """
+    def __init__(self, path=':memory:', batch_size=1000):
+        """
+        :param path: Database file, created when it doesn't exist.
+        :param batch_size: Number of rows inserted per executemany call.
+        """
+        # Imported here rather than with sacp, see TestStartup.
+        import sqlite3
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(_schema)
+        self.batch_size = batch_size
+        self._pending = {}
+
+    def export(self, root, server):
+        """
+        Stores the tree below root, including the files it includes, in place of what was exported for server before.
+        :param root: ConfigFile to export.
+        :param server: Name identifying the server the config belongs to.
+        :return: List of the paths of the files that were (re)written, unchanged files are left out.
+        """
+        exported = []
+        visited = set()
+        with self.connection:
+            self._export_file(root, server, None, exported, visited)
+            self._flush()
+            for (file_id,) in self.connection.execute("SELECT id FROM files WHERE server = ?", (server,)).fetchall():
+                if file_id not in visited:
+                    self._delete_nodes(file_id)
+                    self.connection.execute("DELETE FROM files WHERE id = ?", (file_id,))
+        return exported
+
+    def forget(self, server):
+        """
+        Removes everything exported for server.
+        """
+        with self.connection:
+            for (file_id,) in self.connection.execute("SELECT id FROM files WHERE server = ?", (server,)).fetchall():
+                self._delete_nodes(file_id)
+            self.connection.execute("DELETE FROM files WHERE server = ?", (server,))
+
+    def find(self, name, argument=None, server=None):
+        """
+        :param name: Directive or section name, case insensitive.
+        :param argument: When given only nodes with this exact argument are returned.
+        :param server: When given only nodes of this server are returned.
+        :return: List of (server, file, line, arguments) tuples.
+        """
+        sql = "SELECT nodes.server, files.path, nodes.line, nodes.arguments FROM nodes " \
+              "JOIN files ON files.id = nodes.file_id WHERE nodes.name = ?"
+        parameters = [name]
+        if argument is not None:
+            sql += " AND nodes.id IN (SELECT node_id FROM arguments WHERE value = ?)"
+            parameters.append(argument)
+        if server is not None:
+            sql += " AND nodes.server = ?"
+            parameters.append(server)
+        return self.connection.execute(sql + " ORDER BY nodes.server, files.path, nodes.line", parameters).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+    def _export_file(self, cf, server, include_id, exported, visited):
+        digest = hashlib.sha256()
+        for chunk in cf.iter_chunks():
+            digest.update(chunk.encode())
+        text_hash = digest.hexdigest()
+        path = cf._file or ''
+        row = self.connection.execute("SELECT id, hash FROM files WHERE server = ? AND path = ?",
+                                      (server, path)).fetchone()
+        changed = row is None or row[1] != text_hash
+        if row is None:
+            file_id = self.connection.execute("INSERT INTO files (server, path, hash, include_id) VALUES (?, ?, ?, ?)",
+                                              (server, path, text_hash, include_id)).lastrowid
+        else:
+            file_id = row[0]
+            self.connection.execute("UPDATE files SET hash = ?, include_id = ? WHERE id = ?",
+                                    (text_hash, include_id, file_id))
+            if changed:
+                self._flush()
+                self._delete_nodes(file_id)
+        visited.add(file_id)
+
+        nodes = [(node, line) for node, line in LineEnumerator(nodes=cf.children).lines
+                 if isinstance(node, Directive)]
+        if changed:
+            exported.append(path)
+            # Ids are assigned here so that rows can refer to their parents before they're inserted.
+            self._flush()
+            base = self.connection.execute("SELECT coalesce(max(id), 0) + 1 FROM nodes").fetchone()[0]
+            ids = {}
+            for position, (node, line) in enumerate(nodes):
+                node_id = ids[id(node)] = base + position
+                arguments = node.arguments
+                self._insert('nodes', (node_id, file_id, position, server, type(node).__name__, node.name,
+                                       ' '.join(arguments), ids.get(id(node._parent)), line, int(node.active)))
+                for index, argument in enumerate(arguments):
+                    self._insert('arguments', (node_id, index, argument))
+            include_ids = [ids[id(node)] for node, line in nodes if isinstance(node, Include)]
+        else:
+            self._flush()
+            positions = [position for position, (node, line) in enumerate(nodes) if isinstance(node, Include)]
+            include_ids = [self.connection.execute("SELECT id FROM nodes WHERE file_id = ? AND position = ?",
+                                                   (file_id, position)).fetchone()[0] for position in positions]
+
+        includes = [node for node, line in nodes if isinstance(node, Include)]
+        for include, node_id in zip(includes, include_ids):
+            for child in include.children:
+                if isinstance(child, ConfigFile):
+                    self._export_file(child, server, node_id, exported, visited)
+
+    def _delete_nodes(self, file_id):
+        self.connection.execute("DELETE FROM arguments WHERE node_id IN (SELECT id FROM nodes WHERE file_id = ?)",
+                                (file_id,))
+        self.connection.execute("DELETE FROM nodes WHERE file_id = ?", (file_id,))
+
+    def _insert(self, table, row):
+        rows = self._pending.setdefault(table, [])
+        rows.append(row)
+        if len(rows) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        for table, rows in self._pending.items():
+            if rows:
+                placeholders = ', '.join('?' * len(rows[0]))
+                self.connection.executemany("INSERT INTO {} VALUES ({})".format(table, placeholders), rows)
+        self._pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,135 @@
+from .base import *
+import weakref
+
+
+class FrozenError(Exception):
+    pass
+
+
+class Frozen:
+    """
+    Mixin for the nodes of a frozen tree. Frozen nodes keep their class, e.g. a frozen VirtualHost is still a
+    VirtualHost, but hold tuples instead of lists, refuse to be modified and have name, arguments, depth, str(),
+    content_hash and newlines computed up front. Nothing is written on read, so any number of threads can read a
+    frozen tree without locking.
+    """
+    _thawed_class = None
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get('_sealed'):
+            raise FrozenError("frozen nodes can't be modified, thaw() them first")
+        object.__setattr__(self, name, value)
+
+    @property
+    def tokens(self):
+        return tuple(super().tokens)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def arguments(self):
+        return self._arguments
+
+    @property
+    def depth(self):
+        return self._depth
+
+    def __str__(self):
+        return self._str
+
+    def invalidate(self):
+        raise FrozenError("frozen nodes can't be modified, thaw() them first")
+
+    def append_child(self, node):
+        raise FrozenError("frozen nodes can't be modified, thaw() them first")
+
+    def append_children(self, nodes):
+        raise FrozenError("frozen nodes can't be modified, thaw() them first")
+
+    def __reduce__(self):
+        # Frozen classes are made on the fly and can't be found by name, unpickling rebuilds them from the class thawed
+        # nodes have. The state is set without going through __setattr__, see Node.__setstate__.
+        return _new_frozen, (self._thawed_class,), self.__getstate__()
+
+    def thaw(self):
+        """
+        :return: Editable copy of this node. Its children are the frozen children themselves, shared with this tree,
+                 use thaw_child to make the ones being edited editable too. The copy has no parent, edits would
+                 otherwise reach the frozen ancestors, thaw_child gives it its editable one.
+        """
+        node = self._thawed_class.__new__(self._thawed_class)
+        for name, value in self.__dict__.items():
+            if name not in _precomputed and name != '_parent_link':
+                node.__dict__[name] = value
+        node._pretokens = list(self._pretokens)
+        node._children = list(self._children)
+        node._posttokens = list(self._posttokens)
+        return node
+
+
+# Attributes only frozen nodes have.
+_precomputed = frozenset(['_sealed', '_name', '_arguments', '_depth', '_str'])
+
+_frozen_classes = {}
+
+
+def _frozen_class(cls):
+    frozen = _frozen_classes.get(cls)
+    if frozen is None:
+        frozen = type('Frozen' + cls.__name__, (Frozen, cls), {'_thawed_class': cls})
+        _frozen_classes[cls] = frozen
+    return frozen
+
+
+def _new_frozen(cls):
+    frozen = _frozen_class(cls)
+    return frozen.__new__(frozen)
+
+
+def freeze(node):
+    """
+    :return: Immutable copy of the tree below node, the original tree is left untouched. The copy is a tree of its
+             own, its root has no parent. Frozen subtrees found below node are shared rather than copied, they keep
+             the parent they were frozen with.
+    """
+    if isinstance(node, Frozen):
+        return node
+    return _freeze(node, None, 0)
+
+
+def _freeze(node, parent, depth):
+    # Compute the caches on the original first, they're copied along with the rest of the node's attributes.
+    node.content_hash
+    node.newlines
+    frozen = _new_frozen(type(node))
+    attributes = frozen.__dict__
+    attributes.update(node.__dict__)
+    # Parsers hold on to the original, mutable, list of nodes.
+    attributes.pop('_parser', None)
+    attributes['_parent_link'] = weakref.ref(parent) if node._weak_parent and parent is not None else parent
+    attributes['_pretokens'] = tuple(node._pretokens)
+    attributes['_posttokens'] = tuple(node._posttokens)
+    attributes['_children'] = tuple([child if isinstance(child, Frozen) else _freeze(child, frozen, depth + 1)
+                                     for child in node._children])
+    attributes['_depth'] = depth
+    if isinstance(node, Directive):
+        attributes['_name'] = node.name
+        attributes['_arguments'] = tuple(node.arguments)
+    attributes['_str'] = str(node)
+    attributes['_sealed'] = True
+    return frozen
+
+
+def thaw_child(parent, index):
+    """
+    Replaces a frozen child of an editable node with an editable copy.
+    :return: The editable child.
+    """
+    child = parent._children[index]
+    if isinstance(child, Frozen):
+        child = child.thaw()
+        child._parent = parent
+        parent._children[index] = child
+    return child
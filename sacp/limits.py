@@ -0,0 +1,200 @@
+import os
+import time
+
+
+class LimitExceeded(Exception):
+    """
+    Raised when a parse goes over one of its ParseLimits. limit names the limit, stats holds the counts reached so far.
+    """
+    def __init__(self, limit, stats):
+        Exception.__init__(self, "{} limit exceeded after {}".format(limit, ', '.join(
+            '{} {}'.format(value, name) for name, value in stats.items())))
+        self.limit = limit
+        self.stats = stats
+
+
+class Cancelled(LimitExceeded):
+    """
+    Raised when the CancelToken of a parse was cancelled.
+    """
+    def __init__(self, stats):
+        LimitExceeded.__init__(self, 'cancel', stats)
+
+
+class CancelToken:
+    """
+    Lets another thread stop a parse, the parse checks it before every file and every few thousand tokens.
+    """
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ParseLimits:
+    """
+    Bounds the resources a parse may use, for configs that can't be trusted. Limits that are None aren't enforced.
+    The counts are totals over every file of the parse, so use one ParseLimits per parse. When a limit is exceeded
+    LimitExceeded is raised with the counts reached so far.
+
+    Example:
+    limits = ParseLimits(max_bytes=1 << 20, max_include_depth=4, timeout=2.0, cancel=CancelToken())
+    try:
+        cf = ConfigFile(file=upload, limits=limits)
+    except LimitExceeded as e:
+        print(e.limit, e.stats)
+    """
+    # The clock & cancel token are checked every this many tokens.
+    check_interval = 1024
+
+    def __init__(self, max_bytes=None, max_tokens=None, max_nodes=None, max_depth=None, max_include_depth=None,
+                 max_fanout=None, max_files=None, timeout=None, cancel=None):
+        """
+        :param max_bytes: Total size of the config text parsed.
+        :param max_tokens: Total number of tokens lexed.
+        :param max_nodes: Total number of nodes built.
+        :param max_depth: Nesting depth of sections, sections of included files count from the section the Include
+                          is in.
+        :param max_include_depth: Nesting depth of included files.
+        :param max_fanout: Number of files a single Include may load.
+        :param max_files: Total number of files loaded, also enforced while Include patterns are expanded.
+        :param timeout: Seconds the parse may take, counted from its start.
+        :param cancel: CancelToken checked between files and while Include patterns are expanded.
+        """
+        self.max_bytes = max_bytes
+        self.max_tokens = max_tokens
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.max_include_depth = max_include_depth
+        self.max_fanout = max_fanout
+        self.max_files = max_files
+        self.timeout = timeout
+        self.cancel = cancel
+        self.bytes = 0
+        self.tokens = 0
+        self.nodes = 0
+        self.files = 0
+        self.depth = 0
+        self.include_depth = 0
+        self._deadline = None
+        self._started = None
+
+    @property
+    def stats(self):
+        """
+        :return: Dictionary of the counts reached so far.
+        """
+        elapsed = time.monotonic() - self._started if self._started is not None else 0.0
+        return {'bytes': self.bytes, 'tokens': self.tokens, 'nodes': self.nodes, 'files': self.files,
+                'depth': self.depth, 'include depth': self.include_depth, 'seconds': round(elapsed, 3)}
+
+    def start(self):
+        """
+        Starts the clock, done by the first Parser using the limits.
+        """
+        if self._started is None:
+            self._started = time.monotonic()
+            if self.timeout is not None:
+                self._deadline = self._started + self.timeout
+
+    def check(self):
+        """
+        :raises Cancelled: When the cancel token was cancelled.
+        :raises LimitExceeded: When the parse ran out of time.
+        """
+        if self.cancel is not None and self.cancel.cancelled:
+            raise Cancelled(self.stats)
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            self.exceeded('timeout')
+
+    def exceeded(self, limit):
+        raise LimitExceeded(limit, self.stats)
+
+    def open(self, path):
+        """
+        Called before a file is read, it isn't read at all when it would go over max_bytes.
+        """
+        self.start()
+        self.check()
+        self.files += 1
+        if self.max_files is not None and self.files > self.max_files:
+            self.exceeded('files')
+        if self.max_bytes is not None and self.bytes + os.path.getsize(path) > self.max_bytes:
+            self.exceeded('bytes')
+
+    def read(self, data):
+        self.start()
+        # max_bytes is in bytes like the file sizes open checks, not characters.
+        self.bytes += len(data) if data.isascii() else len(data.encode('utf-8'))
+        if self.max_bytes is not None and self.bytes > self.max_bytes:
+            self.exceeded('bytes')
+
+    def listing(self, found):
+        """
+        Called before each directory an Include pattern lists, so that patterns such as '/' can't run unbounded.
+        :param found: Number of files the pattern matched so far, they're all loaded afterwards.
+        """
+        self.check()
+        if self.max_files is not None and self.files + found > self.max_files:
+            self.exceeded('files')
+
+    def charge(self, files, bytes, tokens, nodes, depth, include_depth, fanout):
+        """
+        Counts files that aren't parsed again, e.g. those of a tree an InternStore shares, as if they were.
+        :param depth: Deepest nesting of sections within the files.
+        :param include_depth: Deepest nesting of includes within the files.
+        :param fanout: Most files loaded by one of their Includes.
+        """
+        self.start()
+        self.check()
+        self.files += files
+        self.bytes += bytes
+        self.tokens += tokens
+        self.nodes += nodes
+        for limit, maximum, count in (('files', self.max_files, self.files), ('bytes', self.max_bytes, self.bytes),
+                                      ('tokens', self.max_tokens, self.tokens), ('nodes', self.max_nodes, self.nodes),
+                                      ('depth', self.max_depth, self.depth + depth),
+                                      ('include depth', self.max_include_depth, self.include_depth + include_depth),
+                                      ('fanout', self.max_fanout, fanout)):
+            if maximum is not None and count > maximum:
+                self.exceeded(limit)
+
+    def count_tokens(self, stream):
+        """
+        :return: Generator passing on the tokens of stream while counting them.
+        """
+        interval = self.check_interval
+        for token in stream:
+            self.tokens += 1
+            if self.max_tokens is not None and self.tokens > self.max_tokens:
+                self.exceeded('tokens')
+            if not self.tokens % interval:
+                self.check()
+            yield token
+
+    def node(self):
+        self.nodes += 1
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            self.exceeded('nodes')
+
+    def enter_section(self):
+        self.depth += 1
+        if self.max_depth is not None and self.depth > self.max_depth:
+            self.exceeded('depth')
+
+    def exit_section(self):
+        self.depth -= 1
+
+    def enter_include(self, fanout):
+        """
+        :param fanout: Number of files the Include loads.
+        """
+        self.include_depth += 1
+        if self.max_include_depth is not None and self.include_depth > self.max_include_depth:
+            self.exceeded('include depth')
+        if self.max_fanout is not None and fanout > self.max_fanout:
+            self.exceeded('fanout')
+
+    def exit_include(self):
+        self.include_depth -= 1
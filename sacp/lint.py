@@ -0,0 +1,109 @@
+from .base import *
+from .utilities import *
+import re
+
+
+class Finding:
+    """
+    A single problem reported by a Rule, along with where the offending node was found.
+    """
+    def __init__(self, rule, node, message, file=None, line=None):
+        self.rule = rule
+        self.node = node
+        self.message = message
+        self.file = file
+        self.line = line
+
+    def __str__(self):
+        return "{}:{}: {}: {}".format(self.file, self.line, self.rule.name, self.message)
+
+    def __repr__(self):
+        return "<Finding {}>".format(self)
+
+
+class Rule:
+    """
+    Base class for lint rules.
+
+    Rules declare the (case insensitive) directive and section names they apply to, the LintEngine only hands a rule
+    the nodes matching those names. Patterns used by a rule should be compiled once as class attributes rather than
+    on each call to check.
+    """
+    name = None
+    directives = ()
+    sections = ()
+
+    def check(self, node):
+        """
+        :param node: Directive or ScopedDirective matching one of the declared names.
+        :return: List of messages describing problems with the node, an empty list means the node passed.
+        """
+        raise NotImplementedError
+
+
+class ServerNameRule(Rule):
+    name = 'server-name'
+    directives = ('ServerName',)
+    pattern = re.compile(r'^((?P<scheme>[a-zA-Z]+)(://))?(?P<domain>[a-zA-Z_0-9.]+)(:(?P<port>[0-9]+))?\s*$')
+
+    def check(self, node):
+        arguments = node.arguments
+        if len(arguments) != 1:
+            return ["ServerName takes exactly one argument"]
+        if not self.pattern.search(arguments[0]):
+            return ["invalid server name '{}'".format(arguments[0])]
+        return []
+
+
+class ServerAliasRule(Rule):
+    name = 'server-alias'
+    directives = ('ServerAlias',)
+    pattern = re.compile(r'^(?P<domain>[a-zA-Z_0-9.]+)\s*$')
+
+    def check(self, node):
+        arguments = node.arguments
+        if len(arguments) == 0:
+            return ["ServerAlias requires at least one argument"]
+        return ["invalid server alias '{}'".format(name) for name in arguments if not self.pattern.search(name)]
+
+
+DEFAULT_RULES = (ServerNameRule, ServerAliasRule)
+
+
+class LintEngine:
+    """
+    Runs a set of rules over a tree in a single walk. Each node is dispatched by name only to the rules that declared
+    interest in it, so adding rules does not add tree walks.
+    """
+    def __init__(self, rules=None):
+        if rules is None:
+            rules = [rule() for rule in DEFAULT_RULES]
+        self.rules = list(rules)
+        self._directives = {}
+        self._sections = {}
+        for rule in self.rules:
+            if not isinstance(rule, Rule):
+                raise ValueError("rules must be of type Rule")
+            for name in rule.directives:
+                self._directives.setdefault(name.lower(), []).append(rule)
+            for name in rule.sections:
+                self._sections.setdefault(name.lower(), []).append(rule)
+
+    def run(self, nodes):
+        """
+        :param nodes: List of nodes to lint, e.g. [ConfigFile(file='conf/httpd.conf')].
+        :return: List of Findings in tree order.
+        """
+        return self._check([entry for entry in located_nodes(nodes) if isinstance(entry[0], Directive)])
+
+    def _check(self, located):
+        findings = []
+        for node, file, line in located:
+            table = self._sections if isinstance(node, ScopedDirective) else self._directives
+            rules = table.get(node.name.lower())
+            if not rules:
+                continue
+            for rule in rules:
+                for message in rule.check(node):
+                    findings.append(Finding(rule, node, message, file=file, line=line))
+        return findings
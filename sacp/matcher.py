@@ -0,0 +1,288 @@
+from .base import *
+from .utilities import *
+import posixpath
+import re
+
+
+# Numbered & named back references only work in the pattern they were written for, see RegexSet.
+_backreference_re = re.compile(r'\\[1-9]|\(\?P=')
+# PCRE style named groups, e.g. (?<name>...), which Python spells (?P<name>...).
+_pcre_group_re = re.compile(r'\(\?<(?=[A-Za-z_])')
+
+
+def compile_regex(pattern, flags=0):
+    """
+    Compiles a PCRE style pattern as used in Apache configs into a Python regular expression.
+    """
+    return re.compile(_pcre_group_re.sub('(?P<', pattern), flags)
+
+
+def wildcard_regex(pattern, anchor_end=True):
+    """
+    Translates an Apache wildcard pattern, where '*' and '?' never match '/', into a regular expression.
+    :param anchor_end: When False the pattern only has to match whole leading path components.
+    """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '*':
+            regex.append('[^/]*')
+        elif c == '?':
+            regex.append('[^/]')
+        elif c == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                regex.append('\\[')
+            else:
+                regex.append(pattern[i:end + 1])
+                i = end
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return '^' + ''.join(regex) + ('$' if anchor_end else '(?:/|$)')
+
+
+def is_wildcard(pattern):
+    return '*' in pattern or '?' in pattern or '[' in pattern
+
+
+class RegexSet:
+    """
+    A set of precompiled regular expressions that are all searched with a single match call. Each pattern is wrapped
+    in an optional lookahead followed by an empty marker group, the marker groups that participate in the match tell
+    which of the patterns were found. Patterns that can't be combined, e.g. those using back references, are searched
+    on their own.
+    """
+    def __init__(self, patterns, flags=0):
+        self.patterns = list(patterns)
+        self._separate = []
+        self._markers = []
+        combined = []
+        group = 0
+        for index, pattern in enumerate(self.patterns):
+            compiled = compile_regex(pattern, flags)
+            if _backreference_re.search(pattern) or len(self.patterns) == 1:
+                self._separate.append((index, compiled))
+                continue
+            combined.append('(?:(?=.*?(?:{}))())?'.format(compiled.pattern))
+            group += compiled.groups + 1
+            self._markers.append((group, index, compiled))
+        self._combined = None
+        if self._markers:
+            try:
+                self._combined = re.compile(''.join(combined), flags | re.DOTALL)
+            except re.error:
+                # e.g. the same group name used in two patterns, fall back to searching each pattern.
+                self._separate.extend((index, compiled) for group, index, compiled in self._markers)
+                self._separate.sort(key=lambda entry: entry[0])
+                self._markers = []
+
+    def matches(self, text):
+        """
+        :return: Sorted list of the indexes of the patterns found in text.
+        """
+        found = []
+        if self._combined is not None:
+            groups = self._combined.match(text).groups()
+            found = [index for group, index, compiled in self._markers if groups[group - 1] is not None]
+        if self._separate:
+            found.extend(index for index, compiled in self._separate if compiled.search(text))
+            found.sort()
+        return found
+
+    def __len__(self):
+        return len(self.patterns)
+
+
+class _PrefixTrie:
+    """
+    Trie of literal paths keyed by path component, a path matches every entry stored along its components.
+    """
+    def __init__(self):
+        self._root = ({}, [])
+
+    def add(self, path, entry, slash=False):
+        node = self._root
+        for part in path.strip('/').split('/'):
+            if part:
+                node = node[0].setdefault(part, ({}, []))
+        node[1].append((entry, slash))
+
+    def find(self, path):
+        found = []
+        node = self._root
+        parts = [part for part in path.split('/') if part]
+        remaining = len(parts)
+        trailing = path.endswith('/')
+        while True:
+            for entry, slash in node[1]:
+                # Paths ending with '/' only match requests below that path, e.g. '/dir/' doesn't match '/dir'.
+                if not slash or remaining or trailing:
+                    found.append(entry)
+            if not remaining:
+                return found
+            node = node[0].get(parts[len(parts) - remaining])
+            if node is None:
+                return found
+            remaining -= 1
+
+
+class _Section:
+    def __init__(self, node, group, order, regex=None, within=None, depth=0):
+        self.node = node
+        self.path = None
+        self.group = group
+        self.order = order
+        self.regex = regex
+        self.within = within
+        self.depth = depth
+
+
+# Groups in the order Apache merges them.
+DIRECTORY, DIRECTORY_MATCH, FILES, LOCATION = range(4)
+
+
+class SectionMatcher:
+    """
+    Finds the <Directory>, <DirectoryMatch>, <Files>, <FilesMatch>, <Location> and <LocationMatch> sections that apply
+    to a request. Literal paths are kept in prefix tries and all regular expressions are combined into precompiled
+    RegexSets, so lookups cost a few trie steps and one regex match per group rather than a scan over every section.
+
+    Example:
+    matcher = SectionMatcher([cf], vhost=vhost)
+    sections = matcher.match(url='/app/index.php', path='/var/www/app/index.php')
+    """
+    def __init__(self, nodes, vhost=None):
+        """
+        :param nodes: Nodes whose sections apply, e.g. [ConfigFile(...)] for the main server.
+        :param vhost: Optional VirtualHost whose sections are applied after the main server's.
+        """
+        self._order = 0
+        self._sections = []
+        self._collect(iter_scope(nodes), scope=0)
+        if vhost is not None:
+            self._collect(iter_scope(vhost.children), scope=1)
+
+        self._directories = _PrefixTrie()
+        self._locations = _PrefixTrie()
+        self._files = {}
+        regex = {DIRECTORY: [], DIRECTORY_MATCH: [], FILES: [], LOCATION: []}
+        for section in self._sections:
+            if section.regex is not None:
+                regex[section.group].append(section)
+            elif section.group == DIRECTORY:
+                self._directories.add(section.path, section)
+            elif section.group == LOCATION:
+                self._locations.add(section.path, section, slash=section.path.endswith('/'))
+            else:
+                self._files.setdefault(section.path, []).append(section)
+        self._regex = {}
+        for group, sections in regex.items():
+            self._regex[group] = (sections, RegexSet([section.regex for section in sections]))
+
+    def _collect(self, nodes, scope, within=None):
+        for node in nodes:
+            if isinstance(node, (Directory, DirectoryMatch)):
+                section = self._add(node, scope, within)
+                if section is not None:
+                    self._collect(iter_scope(node.children), scope, within=section)
+            elif isinstance(node, (Files, FilesMatch, Location, LocationMatch)):
+                self._add(node, scope, within)
+
+    def _add(self, node, scope, within):
+        arguments = node.arguments
+        if not arguments:
+            return None
+        argument = ' '.join(arguments)
+        regex = None
+        if isinstance(node, (DirectoryMatch, FilesMatch, LocationMatch)):
+            regex = unquote(argument)
+        elif argument.startswith('~'):
+            regex = unquote(argument[1:].strip())
+
+        if isinstance(node, (Directory, DirectoryMatch)):
+            group = DIRECTORY if regex is None else DIRECTORY_MATCH
+        elif isinstance(node, (Files, FilesMatch)):
+            group = FILES
+        else:
+            group = LOCATION
+
+        section = _Section(node, group, (scope, self._order), within=within)
+        self._order += 1
+        path = unquote(argument)
+        if regex is not None:
+            section.regex = regex
+        elif group == FILES:
+            if is_wildcard(path):
+                section.regex = wildcard_regex(path)
+        elif is_wildcard(path):
+            # Wildcard directories stay in the DIRECTORY group, they are merged along with the literal ones by
+            # number of path components.
+            section.regex = wildcard_regex(path.rstrip('/') or '/', anchor_end=False)
+        if group == DIRECTORY:
+            path = path.rstrip('/') or '/'
+            section.depth = len([part for part in path.split('/') if part])
+        section.path = path
+        self._sections.append(section)
+        return section
+
+    def _regex_matches(self, group, text):
+        sections, regex_set = self._regex[group]
+        if not sections:
+            return []
+        return [sections[index] for index in regex_set.matches(text)]
+
+    def _directory_sections(self, path):
+        literal = self._directories.find(path) + self._regex_matches(DIRECTORY, path)
+        literal.sort(key=lambda section: (section.order[0], section.depth, section.order[1]))
+        regex = self._regex_matches(DIRECTORY_MATCH, path)
+        regex.sort(key=lambda section: section.order)
+        return literal + regex
+
+    def _files_sections(self, path, directories):
+        name = posixpath.basename(path.rstrip('/'))
+        sections = self._files.get(name, []) + self._regex_matches(FILES, name)
+        matched = set(directories)
+        sections = [section for section in sections if section.within is None or section.within in matched]
+        sections.sort(key=lambda section: section.order)
+        return sections
+
+    def _location_sections(self, url):
+        sections = self._locations.find(url) + self._regex_matches(LOCATION, url)
+        sections.sort(key=lambda section: section.order)
+        return sections
+
+    def directories(self, path):
+        """
+        :return: List of the <Directory> & <DirectoryMatch> sections applying to a filesystem path, in merge order.
+        """
+        return [section.node for section in self._directory_sections(path)]
+
+    def files(self, path):
+        """
+        :return: List of the <Files> & <FilesMatch> sections applying to a filesystem path, in merge order.
+        """
+        return [section.node for section in self._files_sections(path, self._directory_sections(path))]
+
+    def locations(self, url):
+        """
+        :return: List of the <Location> & <LocationMatch> sections applying to a URL path, in merge order.
+        """
+        return [section.node for section in self._location_sections(url)]
+
+    def match(self, url=None, path=None):
+        """
+        :param url: URL path of the request, e.g. '/app/index.php'.
+        :param path: Filesystem path the request maps to, e.g. '/var/www/app/index.php'.
+        :return: List of the sections applying to the request in the order Apache merges them: directories, regex
+                 directories, files and then locations.
+        """
+        sections = []
+        if path is not None:
+            directories = self._directory_sections(path)
+            sections.extend(directories)
+            sections.extend(self._files_sections(path, directories))
+        if url is not None:
+            sections.extend(self._location_sections(url))
+        return [section.node for section in sections]
@@ -1,5 +1,29 @@
+import io
 import re
-from pygments.token import Token
+import hashlib
+import weakref
+from pygments.token import Token, string_to_tokentype
+
+
+def _token_type(name):
+    return string_to_tokentype(name[len('Token.'):])
+
+
+_token_types = {}
+
+
+def _named_tokens(tokens):
+    return type(tokens)([(str(token[0]), token[1]) for token in tokens])
+
+
+def _typed_tokens(tokens):
+    typed = []
+    for name, value in tokens:
+        token_type = _token_types.get(name)
+        if token_type is None:
+            token_type = _token_types[name] = _token_type(name)
+        typed.append((token_type, value))
+    return type(tokens)(typed)
 
 
 class Node:
@@ -13,6 +37,14 @@ class Node:
     When processing tokens, e.g. when rendering, we process pre Token(s) first,
     then the children Node(s), then the post Token(s).
 
+    Nodes inside conditional sections that were evaluated as inactive, e.g. an
+    <IfModule> for a module that isn't loaded, have active set to False.
+
+    Nodes created with weak_parent hold a weak reference to their parent, so a
+    tree has no reference cycles and is freed as soon as its root is no longer
+    referenced, without waiting for the cyclic garbage collector. Keep the root
+    alive for as long as its nodes are used, parent is None once it's freed.
+
     Example:
     <VirtualHost *:80>
     ServerName server
@@ -23,7 +55,23 @@ class Node:
     [</VirtualHost][>][\n] -> posttokens
     """
 
-    def __init__(self, node=None, close_tag=False, parent=None):
+    _active = True
+    # Set on nodes while the Parser builds them, see Parser._build.
+    _parser = None
+    # Bumped on a node and all of its ancestors whenever the node changes, see invalidate.
+    _revision = 0
+    # Line of the node's type token, only recorded by skeleton parses which drop the tokens lines are counted from.
+    _line = None
+    # Cached content hash & newline count, cleared by invalidate.
+    _hash = None
+    _newlines = None
+    # Whether _parent is held through a weak reference, see parse option weak_parents.
+    _weak_parent = False
+    _parent_link = None
+
+    def __init__(self, node=None, close_tag=False, parent=None, weak_parent=False):
+        if weak_parent or (node is not None and node._weak_parent):
+            self._weak_parent = True
         self._parent = parent
         self._pretokens = []
         self._children = []
@@ -35,6 +83,12 @@ class Node:
             self._children = node._children or []
             self._posttokens = node._posttokens or []
             self.closeTag = node.closeTag
+            if not node._active:
+                self._active = False
+            if node._parser is not None:
+                self._parser = node._parser
+            if node._line is not None:
+                self._line = node._line
 
     @property
     def tokens(self):
@@ -52,6 +106,19 @@ class Node:
             tokenList.append(token)
         return tokenList
 
+    @property
+    def _parent(self):
+        parent = self._parent_link
+        if self._weak_parent and parent is not None:
+            return parent()
+        return parent
+
+    @_parent.setter
+    def _parent(self, parent):
+        if self._weak_parent and parent is not None:
+            parent = weakref.ref(parent)
+        self._parent_link = parent
+
     @property
     def parent(self):
         return self._parent
@@ -78,6 +145,13 @@ class Node:
                 return token
         return None
 
+    @property
+    def active(self):
+        """
+        :return: False when the node is inside a conditional section that was evaluated as inactive.
+        """
+        return self._active
+
     @property
     def depth(self):
         depth = 0
@@ -87,19 +161,144 @@ class Node:
             node = node._parent
         return depth
 
+    @property
+    def revision(self):
+        """
+        :return: Counter that changes whenever this node or any of its descendants change, caches built from a
+                 tree compare it to decide whether they're stale.
+        """
+        return self._revision
+
+    @property
+    def content_hash(self):
+        """
+        :return: Digest of the node's tokens and its children's content hashes, identical subtrees have identical
+                 hashes. The hash is cached until the node is invalidated.
+        """
+        if self._hash is None:
+            digest = hashlib.blake2b(digest_size=16)
+            for token in self._pretokens:
+                digest.update(token[1].encode())
+                digest.update(b'\0')
+            for child in self._children:
+                digest.update(b'\1')
+                digest.update(child.content_hash)
+            for token in self._posttokens:
+                digest.update(b'\2')
+                digest.update(token[1].encode())
+            self._hash = digest.digest()
+        return self._hash
+
+    @property
+    def newlines(self):
+        """
+        :return: Number of lines the node's tokens span in the file it was read from, cached like content_hash.
+        """
+        if self._newlines is None:
+            count = 0
+            for token in self._pretokens:
+                count += token[1].count('\n')
+            for child in self._children:
+                count += child.newlines
+            for token in self._posttokens:
+                count += token[1].count('\n')
+            self._newlines = count
+        return self._newlines
+
+    def invalidate(self):
+        """
+        Marks this node and its ancestors as changed. This is done by append_child, call it after modifying a node's
+        tokens or children lists directly.
+        """
+        node = self
+        while node is not None:
+            node._revision += 1
+            node._hash = None
+            node._newlines = None
+            node = node._parent
+
     def append_child(self, node):
         node._parent = self
         self._children.append(node)
+        self.invalidate()
 
     def append_children(self, nodes):
         for node in nodes:
             self.append_child(node)
 
+    def __getstate__(self):
+        # Parents are restored from their children when unpickled, weak references can't be pickled. The parser is
+        # only needed while the tree is built.
+        # Token types are pickled by name so that unpickled tokens get back the types compared with `is`.
+        state = self.__dict__.copy()
+        state.pop('_parent_link', None)
+        state.pop('_parser', None)
+        state['_pretokens'] = _named_tokens(self._pretokens)
+        state['_posttokens'] = _named_tokens(self._posttokens)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__['_pretokens'] = _typed_tokens(state['_pretokens'])
+        self.__dict__['_posttokens'] = _typed_tokens(state['_posttokens'])
+        for child in self._children:
+            # Set through __dict__ so that frozen children, which refuse attribute writes, get their parent back too.
+            if child.__dict__.get('_parent_link') is None:
+                child.__dict__['_parent_link'] = weakref.ref(self) if child._weak_parent else self
+
+    def _texts(self):
+        # Text of the tokens in render order, without building the token lists tokens does.
+        for token in self._pretokens:
+            yield token[1]
+        for child in self._children:
+            yield from child._texts()
+        for token in self._posttokens:
+            yield token[1]
+
+    def iter_chunks(self, chunk_size=65536):
+        """
+        Renders the node piece by piece, each chunk is yielded as soon as it's complete so only one chunk is held in
+        memory at a time.
+        :param chunk_size: Number of characters after which a chunk is yielded, chunks end on token boundaries so they
+                           can be a little longer.
+        :return: Generator of strings that together equal str(node).
+        """
+        pieces = []
+        size = 0
+        for text in self._texts():
+            pieces.append(text)
+            size += len(text)
+            if size >= chunk_size:
+                yield ''.join(pieces)
+                pieces = []
+                size = 0
+        if pieces:
+            yield ''.join(pieces)
+
+    def render_to(self, stream, chunk_size=65536, encoding='utf-8'):
+        """
+        Writes the node's text to stream in chunks rather than building the whole text first. Text streams are
+        written str chunks, binary streams, e.g. files opened with 'wb', BytesIO or gzip files, are written encoded
+        chunks and sockets are sent them with sendall.
+        :param encoding: Encoding used for binary streams and sockets.
+        :return: Number of characters rendered.
+        """
+        if isinstance(stream, io.TextIOBase):
+            write = stream.write
+        elif hasattr(stream, 'sendall'):
+            write = lambda chunk: stream.sendall(chunk.encode(encoding))
+        elif isinstance(stream, (io.RawIOBase, io.BufferedIOBase)) or 'b' in str(getattr(stream, 'mode', '')):
+            write = lambda chunk: stream.write(chunk.encode(encoding))
+        else:
+            write = stream.write
+        count = 0
+        for chunk in self.iter_chunks(chunk_size):
+            write(chunk)
+            count += len(chunk)
+        return count
+
     def __str__(self):
-        s = ''
-        for token in self.tokens:
-            s += "{}".format(token[1])
-        return s
+        return ''.join([token[1] for token in self.tokens])
 
 
 class NodeFactory:
@@ -0,0 +1,155 @@
+import fnmatch
+import os
+import stat
+
+
+class Resolver:
+    """
+    Resolves Include and IncludeOptional patterns for a parse. Directory listings and stat results are cached, so
+    includes that point at the same directories only scan them once, and relative patterns are resolved against
+    ServerRoot rather than the current directory.
+
+    A Parser creates a Resolver for each parse unless one is given, pass the same Resolver to several parses to share
+    its cache between them. calls and saved count the filesystem calls made and those answered from the cache.
+
+    Example:
+    resolver = Resolver(server_root='/etc/httpd')
+    cf = ConfigFile(file='conf/httpd.conf', resolver=resolver)
+    print(resolver.calls, resolver.saved)
+    """
+    def __init__(self, server_root=None):
+        """
+        :param server_root: Directory relative paths are resolved against. When None the ServerRoot directive sets
+                            it, until then paths are relative to the current directory.
+        """
+        self.server_root = server_root
+        self._pinned = server_root is not None
+        self.calls = 0
+        self.saved = 0
+        self._stats = {}
+        self._listings = {}
+
+    def clear(self):
+        """
+        Forgets the cached filesystem state, e.g. after files were added or removed.
+        """
+        self._stats.clear()
+        self._listings.clear()
+
+    def observe(self, node):
+        """
+        Picks up ServerRoot from the config when no server root was configured.
+        """
+        if self._pinned or not node.arguments:
+            return
+        self.server_root = node.arguments[0].strip('"')
+
+    def resolve(self, path):
+        """
+        :return: path made absolute against the server root, or unchanged without a server root.
+        """
+        if self.server_root and not os.path.isabs(path):
+            return os.path.join(self.server_root, path)
+        return path
+
+    def stat(self, path):
+        """
+        :return: os.stat_result for path or None when it doesn't exist.
+        """
+        if path in self._stats:
+            self.saved += 1
+            return self._stats[path]
+        self.calls += 1
+        try:
+            result = os.stat(path)
+        except OSError:
+            result = None
+        self._stats[path] = result
+        return result
+
+    def listdir(self, directory):
+        """
+        :return: Sorted list of the names in directory, empty when it can't be read.
+        """
+        if directory in self._listings:
+            self.saved += 1
+            return self._listings[directory]
+        self.calls += 1
+        try:
+            names = sorted(os.listdir(directory or os.curdir))
+        except OSError:
+            names = []
+        self._listings[directory] = names
+        return names
+
+    def isdir(self, path):
+        result = self.stat(path)
+        return result is not None and stat.S_ISDIR(result.st_mode)
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def glob(self, pattern, limit=None, limits=None):
+        """
+        Expands an Include pattern the way Apache does: wildcards may appear in any path component and matching
+        directories are replaced by every file found below them.
+        :param limit: Stop looking once more than this many files were found, e.g. for patterns such as '/'.
+        :param limits: ParseLimits of the parse, checked before every directory listed, see ParseLimits.listing.
+        :return: Sorted list of matching file paths, at most limit + 1 of them when a limit is given.
+        """
+        pattern = self.resolve(pattern)
+        if not _has_magic(pattern):
+            paths = [pattern] if self.exists(pattern) else []
+        else:
+            paths = self._expand(pattern, limits)
+        files = []
+        for path in paths:
+            if limit is not None and len(files) > limit:
+                break
+            if self.isdir(path):
+                self._walk(path, files, limit, limits, set())
+            else:
+                files.append(path)
+        return files
+
+    def _expand(self, pattern, limits):
+        directory, name = os.path.split(pattern)
+        if directory and directory != pattern and _has_magic(directory):
+            directories = [path for path in self._expand(directory, limits) if self.isdir(path)]
+        else:
+            directories = [directory]
+        if not _has_magic(name):
+            return [os.path.join(d, name) for d in directories if self.exists(os.path.join(d, name))]
+        paths = []
+        for d in directories:
+            if limits is not None:
+                limits.listing(0)
+            for entry in self.listdir(d):
+                # Like shell globs, wildcards don't match hidden files.
+                if entry[0] == '.' and name[0] != '.':
+                    continue
+                if fnmatch.fnmatchcase(entry, name):
+                    paths.append(os.path.join(d, entry))
+        return paths
+
+    def _walk(self, directory, files, limit, limits, visited):
+        # Symbolic links are followed, visited holds the (device, inode) of the directories walked so that links back
+        # up the tree aren't walked forever.
+        result = self.stat(directory)
+        if result is None or (result.st_dev, result.st_ino) in visited:
+            return
+        visited.add((result.st_dev, result.st_ino))
+        if limits is not None:
+            limits.listing(len(files))
+        for entry in self.listdir(directory):
+            if limit is not None and len(files) > limit:
+                return
+            path = os.path.join(directory, entry)
+            if self.isdir(path):
+                self._walk(path, files, limit, limits, visited)
+            else:
+                files.append(path)
+
+
+def _has_magic(pattern):
+    return '*' in pattern or '?' in pattern or '[' in pattern
@@ -0,0 +1,282 @@
+from .base import *
+from .utilities import *
+from .matcher import compile_regex
+import os
+import re
+
+
+# Back references in substitutions & conditions: $N to the rule's groups, %N to the last condition's groups and
+# %{NAME} to server variables.
+_reference_re = re.compile(r'\$(\d)|%(\d)|%\{([^}]*)\}')
+
+
+def parse_flags(argument):
+    """
+    :return: Dictionary of the flags in a '[L,NC,R=301]' style argument, names upper cased, values None when not given.
+    """
+    flags = {}
+    if argument and argument[0] == '[' and argument[-1] == ']':
+        for flag in argument[1:-1].split(','):
+            name, _, value = flag.strip().partition('=')
+            if name:
+                flags[name.upper()] = value or None
+    return flags
+
+
+class RewriteCondition:
+    """
+    A compiled RewriteCond: TestString CondPattern [flags]. Supports regular expressions (optionally negated with !),
+    the lexicographic comparisons =, <, >, <=, >= and the file tests -d, -f, -s, -l which check the local filesystem.
+    """
+    def __init__(self, node):
+        self.node = node
+        arguments = [unquote(argument) for argument in node.arguments]
+        if len(arguments) < 2:
+            raise ValueError("RewriteCond needs a test string and a pattern")
+        self.test = arguments[0]
+        self.flags = parse_flags(arguments[2]) if len(arguments) > 2 else {}
+        self.ornext = 'OR' in self.flags or 'ORNEXT' in self.flags
+        pattern = arguments[1]
+        self.negate = pattern[0] == '!'
+        if self.negate:
+            pattern = pattern[1:]
+        self.regex = None
+        self.operator = None
+        for operator in ('<=', '>=', '=', '<', '>', '-d', '-f', '-s', '-l'):
+            if pattern.startswith(operator):
+                self.operator = operator
+                self.operand = pattern[len(operator):]
+                break
+        if self.operator is None:
+            self.regex = compile_regex(pattern, re.IGNORECASE if 'NC' in self.flags else 0)
+
+    def match(self, request, rule_match, cond_match):
+        """
+        :return: Match object or True when the condition holds, None or False otherwise.
+        """
+        value = _expand(self.test, request, rule_match, cond_match)
+        if self.regex is not None:
+            result = self.regex.search(value)
+            if self.negate:
+                return result is None
+            return result
+        operator = self.operator
+        if operator[0] == '-':
+            result = {'-d': os.path.isdir, '-f': os.path.isfile, '-l': os.path.islink,
+                      '-s': lambda path: os.path.isfile(path) and os.path.getsize(path) > 0}[operator](value)
+        else:
+            operand = self.operand
+            if 'NC' in self.flags:
+                value, operand = value.lower(), operand.lower()
+            result = {'=': value == operand, '<': value < operand, '>': value > operand,
+                      '<=': value <= operand, '>=': value >= operand}[operator]
+        return result != self.negate
+
+
+class RewriteRule:
+    """
+    A compiled RewriteRule: Pattern Substitution [flags], along with the RewriteConds before it.
+    """
+    def __init__(self, node, conditions):
+        self.node = node
+        self.conditions = conditions
+        arguments = [unquote(argument) for argument in node.arguments]
+        if len(arguments) < 2:
+            raise ValueError("RewriteRule needs a pattern and a substitution")
+        pattern, self.substitution = arguments[0], arguments[1]
+        self.flags = parse_flags(arguments[2]) if len(arguments) > 2 else {}
+        self.negate = pattern[0] == '!'
+        if self.negate:
+            pattern = pattern[1:]
+        self.regex = compile_regex(pattern, re.IGNORECASE if 'NC' in self.flags else 0)
+        self.last = 'L' in self.flags or 'END' in self.flags
+        self.chain = 'C' in self.flags or 'CHAIN' in self.flags
+        redirect = self.flags.get('R', False) if 'R' in self.flags else self.flags.get('REDIRECT', False)
+        self.redirect = None if redirect is False else int(redirect or 302)
+
+    def conditions_hold(self, request, rule_match):
+        """
+        :return: (holds, last condition match) tuple, consecutive conditions flagged OR are true when any of them is.
+        """
+        cond_match = None
+        i = 0
+        while i < len(self.conditions):
+            holds = False
+            while True:
+                condition = self.conditions[i]
+                i += 1
+                if not holds:
+                    result = condition.match(request, rule_match, cond_match)
+                    if result:
+                        holds = True
+                        if result is not True:
+                            cond_match = result
+                if not condition.ornext or i == len(self.conditions):
+                    break
+            if not holds:
+                return False, cond_match
+        return True, cond_match
+
+
+def _expand(text, request, rule_match, cond_match):
+    if '$' not in text and '%' not in text:
+        return text
+
+    def reference(match):
+        if match.group(1) is not None:
+            return _group(rule_match, int(match.group(1)))
+        if match.group(2) is not None:
+            return _group(cond_match, int(match.group(2)))
+        return request.get(match.group(3).upper(), '')
+    return _reference_re.sub(reference, text)
+
+
+def _group(match, index):
+    if match is None or match is True or index > (match.re.groups if hasattr(match, 're') else 0):
+        return ''
+    return match.group(index) or ''
+
+
+class RewriteResult:
+    """
+    Outcome of rewriting one request. url is the rewritten URL-path, with the query string when there is one, status
+    the redirect's status code or None for internal rewrites and rules the indexes of the rules that matched.
+    """
+    def __init__(self, url, status, rules):
+        self.url = url
+        self.status = status
+        self.rules = rules
+
+    @property
+    def redirect(self):
+        return self.status is not None
+
+    def __eq__(self, other):
+        return isinstance(other, RewriteResult) and (self.url, self.status, self.rules) == \
+            (other.url, other.status, other.rules)
+
+    def __repr__(self):
+        return "<RewriteResult {} {}>".format(self.status or 'internal', self.url)
+
+
+class RewriteChain:
+    """
+    The mod_rewrite rules of one context, e.g. the server config, a virtual host's children or a <Directory>, compiled
+    once so that large numbers of requests, e.g. replayed from access logs, can be rewritten offline. Rules are applied
+    the way mod_rewrite does: in order, each one's RewriteConds checked after its pattern matched, with the flags L,
+    END, NC, OR, R, C, QSA and QSD applied. hits counts the requests each rule matched.
+
+    Example:
+    chain = RewriteChain(vhost.children)
+    results = chain.evaluate_many([('/old/page', 'www.example.com'), ('/index.html', 'example.com')])
+    for rule, hits in zip(chain.rules, chain.hits):
+        print(locate(rule.node), hits)
+    """
+    def __init__(self, nodes, prefix=None):
+        """
+        :param nodes: Nodes of the context, walked with iter_scope so conditional sections & includes are followed.
+        :param prefix: For per-directory rules, the URL-path the directory is served at. It's stripped from the path
+                       before matching and put back in front of relative substitutions, like RewriteBase.
+        """
+        if prefix is not None and not prefix.endswith('/'):
+            prefix += '/'
+        self.prefix = prefix
+        self.enabled = False
+        self.rules = []
+        conditions = []
+        for node in iter_scope(nodes):
+            if not isinstance(node, Directive) or isinstance(node, ScopedDirective):
+                continue
+            name = node.name.lower()
+            if name == 'rewriteengine':
+                self.enabled = bool(node.arguments) and node.arguments[0].lower() == 'on'
+            elif name == 'rewritecond':
+                conditions.append(RewriteCondition(node))
+            elif name == 'rewriterule':
+                self.rules.append(RewriteRule(node, conditions))
+                conditions = []
+        self.hits = [0] * len(self.rules)
+
+    def evaluate(self, path, host=None, query='', variables=None):
+        """
+        :param path: URL-path of the request, e.g. '/index.html'.
+        :param host: Host header, available to conditions as %{HTTP_HOST}.
+        :param query: Query string without the '?'.
+        :param variables: Further server variables for %{NAME} references, e.g. {'HTTPS': 'on'}.
+        :return: RewriteResult.
+        """
+        result = self._evaluate(path, host, query, variables)
+        for index in result.rules:
+            self.hits[index] += 1
+        return result
+
+    def evaluate_many(self, requests, variables=None):
+        """
+        Rewrites a batch of requests, identical requests are only evaluated once.
+        :param requests: Iterable of paths or (path, host) or (path, host, query) tuples.
+        :return: List of RewriteResults in the order of requests.
+        """
+        results = []
+        cache = {}
+        hits = self.hits
+        for request in requests:
+            key = (request,) if isinstance(request, str) else tuple(request)
+            result = cache.get(key)
+            if result is None:
+                result = cache[key] = self._evaluate(*key, variables=variables)
+            for index in result.rules:
+                hits[index] += 1
+            results.append(result)
+        return results
+
+    def _evaluate(self, path, host=None, query='', variables=None):
+        matched = []
+        status = None
+        if not self.enabled:
+            return RewriteResult(path + ('?' + query if query else ''), status, matched)
+        request = {'HTTP_HOST': host or '', 'REQUEST_URI': path, 'QUERY_STRING': query}
+        if variables:
+            request.update((name.upper(), value) for name, value in variables.items())
+        prefix = self.prefix
+        uri = path
+        if prefix is not None and uri.startswith(prefix):
+            uri = uri[len(prefix):]
+        rules = self.rules
+        i = 0
+        while i < len(rules):
+            rule = rules[i]
+            match = rule.regex.search(uri)
+            if (match is None) != rule.negate:
+                holds, cond_match = False, None
+            else:
+                holds, cond_match = rule.conditions_hold(request, match)
+            if not holds:
+                # A chained rule that doesn't match skips the rules chained to it.
+                while rules[i].chain and i + 1 < len(rules):
+                    i += 1
+                i += 1
+                continue
+            matched.append(i)
+            substitution = rule.substitution
+            if substitution != '-':
+                target = _expand(substitution, request, match, cond_match)
+                target, has_query, new_query = target.partition('?')
+                if has_query:
+                    query = new_query + ('&' + query if 'QSA' in rule.flags and query else '')
+                elif 'QSD' in rule.flags:
+                    query = ''
+                if '://' in target:
+                    if rule.redirect is None:
+                        status = 302
+                elif prefix is not None and target.startswith(prefix):
+                    # Later per-directory rules match the new path relative to the directory as well.
+                    target = target[len(prefix):]
+                uri = target
+            if rule.redirect is not None:
+                status = rule.redirect
+            if rule.last:
+                break
+            i += 1
+        if prefix is not None and not uri.startswith('/') and '://' not in uri:
+            uri = prefix + uri
+        return RewriteResult(uri + ('?' + query if query else ''), status, matched)
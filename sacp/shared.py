@@ -0,0 +1,379 @@
+from .base import *
+from .base import _token_type
+from array import array
+import importlib
+import struct
+
+_magic = b'SACPSHM1'
+_header = struct.Struct('<8s6q')
+
+# Columns of the node table, one row of int64 per node. Ids of -1 stand for none.
+(_PARENT, _FIRST_CHILD, _NEXT_SIBLING, _KIND, _NAME, _ARG_START, _ARG_COUNT, _TOKEN_START, _PRE_END, _POST_START,
+ _TOKEN_END, _TEXT_START, _TEXT_END, _LINE, _FILE, _ACTIVE) = range(16)
+_columns = 16
+
+
+class SharedTree:
+    """
+    A parsed tree published to shared memory as one flat, read-only buffer so that worker processes can read it
+    without parsing or unpickling a copy each, the memory a tree takes no longer grows with the number of workers.
+
+    The buffer holds a node table (parent, first child & next sibling ids, class, name, arguments, token range, line
+    and file of every node), the token columns of TokenColumns (type, start & end offset and owning node of every
+    token, offsets are in bytes) and the UTF-8 text of every file. Unlike TokenColumns the files loaded by Include
+    directives are included, as children of their Include like in the tree.
+
+    Processes attach by name and get SharedNode views of the nodes, which read the buffer on demand. The buffer is a
+    snapshot of the tree when it was published.
+
+    Example:
+    with SharedTree.publish(ConfigFile(file="conf/httpd.conf")) as tree:
+        pool.map(worker, [tree.name] * n)
+
+    def worker(name):
+        tree = SharedTree.attach(name)
+        for node in tree.root.children:
+            print(node.name, node.arguments)
+        tree.close()
+    """
+    def __init__(self, shm, owner):
+        self._shm = shm
+        self.owner = owner
+        buf = shm.buf.toreadonly()
+        magic, nodes, tokens, arguments, strings, strings_size, text_size = _header.unpack_from(buf)
+        if magic != _magic:
+            buf.release()
+            raise ValueError("'{}' doesn't hold a SharedTree".format(shm.name))
+        offset = _header.size
+        self._views = [buf]
+
+        def view(size, format=None):
+            nonlocal offset
+            part = buf[offset:offset + size]
+            offset += size
+            if format is not None:
+                part = part.cast(format)
+            self._views.append(part)
+            return part
+        self._nodes = view(nodes * _columns * 8, 'q')
+        self._types = view(tokens * 8, 'q')
+        self._starts = view(tokens * 8, 'q')
+        self._ends = view(tokens * 8, 'q')
+        self._owners = view(tokens * 8, 'q')
+        self._arguments = view(arguments * 8, 'q')
+        self._string_offsets = view((strings + 1) * 8, 'q')
+        self._strings = view(strings_size)
+        self._text = view(text_size)
+        self._decoded = [None] * strings
+        self._token_types = {}
+        self._classes = {}
+        self.root = SharedNode(self, 0) if nodes else None
+
+    @property
+    def name(self):
+        """
+        :return: Name of the shared memory block, pass it to attach.
+        """
+        return self._shm.name
+
+    @property
+    def size(self):
+        return self._shm.size
+
+    def __len__(self):
+        return len(self._nodes) // _columns
+
+    def node(self, index):
+        """
+        :return: SharedNode of the node with id index, ids are assigned in pre-order file by file.
+        """
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return SharedNode(self, index)
+
+    @classmethod
+    def publish(cls, root, name=None):
+        """
+        Copies the tree below root into a new shared memory block. The caller owns the block, call unlink, or use the
+        SharedTree as a context manager, once the workers are done with it.
+        :param root: Node to publish, usually a ConfigFile.
+        :param name: Name of the block, a unique name is picked when None.
+        :return: SharedTree attached to the new block.
+        """
+        # Imported here rather than with sacp, see TestStartup.
+        from multiprocessing import shared_memory
+        data = _flatten(root)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=max(len(data), 1))
+        shm.buf[:len(data)] = data
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """
+        :param name: Name of a block published with publish.
+        :return: Read-only SharedTree of the block.
+        """
+        from multiprocessing import shared_memory
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 attaching registers the block with the resource tracker. Processes started through
+            # multiprocessing share the publisher's tracker, so that's harmless in worker pools.
+            shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, owner=False)
+
+    def close(self):
+        """
+        Detaches from the block, SharedNodes of the tree can't be used afterwards.
+        """
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._shm.close()
+
+    def unlink(self):
+        """
+        Frees the block once every process closed it, only the owner should unlink.
+        """
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if self.owner:
+            self.unlink()
+        return False
+
+    def _string(self, index):
+        string = self._decoded[index]
+        if string is None:
+            offsets = self._string_offsets
+            string = self._decoded[index] = str(self._strings[offsets[index]:offsets[index + 1]], 'utf-8')
+        return string
+
+    def _slice(self, start, end):
+        return str(self._text[start:end], 'utf-8')
+
+    def _token(self, index):
+        type_id = self._types[index]
+        token_type = self._token_types.get(type_id)
+        if token_type is None:
+            token_type = self._token_types[type_id] = _token_type(self._string(type_id))
+        return token_type, self._slice(self._starts[index], self._ends[index])
+
+
+class SharedNode:
+    """
+    Read-only view of a node of a SharedTree with the Node properties readers use: name & arguments for directives,
+    children, parent, tokens and str(). type_name is the node's class name, node_class looks the class up.
+    """
+    __slots__ = ('_tree', '_index')
+
+    def __init__(self, tree, index):
+        self._tree = tree
+        self._index = index
+
+    def _get(self, column):
+        return self._tree._nodes[self._index * _columns + column]
+
+    @property
+    def name(self):
+        """
+        :return: The directive or section name, None for nodes other than Directives.
+        """
+        name = self._get(_NAME)
+        return self._tree._string(name) if name >= 0 else None
+
+    @property
+    def arguments(self):
+        start = self._get(_ARG_START)
+        arguments = self._tree._arguments
+        return [self._tree._string(arguments[i]) for i in range(start, start + self._get(_ARG_COUNT))]
+
+    @property
+    def children(self):
+        children = []
+        child = self._get(_FIRST_CHILD)
+        nodes = self._tree._nodes
+        while child >= 0:
+            children.append(SharedNode(self._tree, child))
+            child = nodes[child * _columns + _NEXT_SIBLING]
+        return children
+
+    @property
+    def parent(self):
+        parent = self._get(_PARENT)
+        return SharedNode(self._tree, parent) if parent >= 0 else None
+
+    @property
+    def active(self):
+        return bool(self._get(_ACTIVE))
+
+    @property
+    def type_name(self):
+        return self._tree._string(self._get(_KIND)).rpartition('.')[2]
+
+    @property
+    def node_class(self):
+        """
+        :return: The class of the published node, None when its module can't be imported.
+        """
+        kind = self._get(_KIND)
+        classes = self._tree._classes
+        if kind not in classes:
+            module, _, name = self._tree._string(kind).rpartition('.')
+            try:
+                classes[kind] = getattr(importlib.import_module(module), name)
+            except (ImportError, AttributeError):
+                classes[kind] = None
+        return classes[kind]
+
+    @property
+    def pretokens(self):
+        return [self._tree._token(i) for i in range(self._get(_TOKEN_START), self._get(_PRE_END))]
+
+    @property
+    def posttokens(self):
+        return [self._tree._token(i) for i in range(self._get(_POST_START), self._get(_TOKEN_END))]
+
+    @property
+    def tokens(self):
+        """
+        :return: List of all the tokens of this node & its children, like Node.tokens.
+        """
+        return [self._tree._token(i) for i in range(self._get(_TOKEN_START), self._get(_TOKEN_END))]
+
+    @property
+    def file(self):
+        file = self._get(_FILE)
+        return self._tree._string(file) if file >= 0 else None
+
+    @property
+    def line(self):
+        return self._get(_LINE)
+
+    def locate(self):
+        """
+        :return: (file, line) tuple like locate.
+        """
+        return self.file, self.line
+
+    def __str__(self):
+        return self._tree._slice(self._get(_TEXT_START), self._get(_TEXT_END))
+
+    def __eq__(self, other):
+        return isinstance(other, SharedNode) and self._tree is other._tree and self._index == other._index
+
+    def __hash__(self):
+        return hash((id(self._tree), self._index))
+
+    def __repr__(self):
+        name = self.name
+        return '<SharedNode {}{}>'.format(self.type_name, ' ' + name if name is not None else '')
+
+
+def _flatten(root):
+    nodes = array('q')
+    types = array('q')
+    starts = array('q')
+    ends = array('q')
+    owners = array('q')
+    arguments = array('q')
+    string_ids = {}
+    strings = []
+    text = []
+    offset = 0
+
+    def string(value):
+        string_id = string_ids.get(value)
+        if string_id is None:
+            string_id = string_ids[value] = len(strings)
+            strings.append(value.encode('utf-8'))
+        return string_id
+
+    def append(token, node_id):
+        nonlocal offset, line
+        piece = token[1].encode('utf-8')
+        types.append(string(str(token[0])))
+        starts.append(offset)
+        offset += len(piece)
+        ends.append(offset)
+        owners.append(node_id)
+        text.append(piece)
+        line += token[1].count('\n')
+
+    def add(node, parent, file):
+        nonlocal line
+        node_id = len(nodes) // _columns
+        row = [-1] * _columns
+        row[_PARENT] = parent
+        row[_KIND] = string(type(node).__module__ + '.' + type(node).__qualname__)
+        if isinstance(node, Directive) and node.type_token is not None:
+            row[_NAME] = string(node.name)
+            row[_ARG_START] = len(arguments)
+            for argument in node.arguments:
+                arguments.append(string(argument))
+            row[_ARG_COUNT] = len(arguments) - row[_ARG_START]
+        else:
+            row[_ARG_START] = row[_ARG_COUNT] = 0
+        row[_FILE] = file
+        row[_ACTIVE] = int(node.active)
+        nodes.extend(row)
+        base_row = node_id * _columns
+        nodes[base_row + _TOKEN_START] = len(types)
+        nodes[base_row + _TEXT_START] = offset
+        type_token = node.type_token
+        node_line = None
+        for token in node._pretokens:
+            if token is type_token:
+                node_line = line
+            append(token, node_id)
+        if node._line is not None:
+            node_line = node._line
+        nodes[base_row + _LINE] = node_line if node_line is not None else line
+        nodes[base_row + _PRE_END] = len(types)
+        previous = -1
+        if isinstance(node, Include):
+            # Included files aren't rendered into the including file, they're laid out after it.
+            pending.extend((child, node_id) for child in node._children)
+        else:
+            for child in node._children:
+                child_id = add(child, node_id, file)
+                link(node_id, previous, child_id)
+                previous = child_id
+        nodes[base_row + _POST_START] = len(types)
+        for token in node._posttokens:
+            append(token, node_id)
+        nodes[base_row + _TOKEN_END] = len(types)
+        nodes[base_row + _TEXT_END] = offset
+        return node_id
+
+    def link(parent, previous, child):
+        if previous < 0:
+            nodes[parent * _columns + _FIRST_CHILD] = child
+        else:
+            nodes[previous * _columns + _NEXT_SIBLING] = child
+
+    # Files are laid out one after the other, pending holds the ConfigFiles of Includes along with the Include.
+    pending = [(root, -1)]
+    last_child = {}
+    while pending:
+        node, parent = pending.pop(0)
+        line = 1
+        file = string(node._file) if isinstance(node, ConfigFile) and node._file is not None else -1
+        node_id = add(node, parent, file)
+        if parent >= 0:
+            link(parent, last_child.get(parent, -1), node_id)
+            last_child[parent] = node_id
+
+    string_offsets = array('q', [0])
+    for encoded in strings:
+        string_offsets.append(string_offsets[-1] + len(encoded))
+    text = b''.join(text)
+    strings = b''.join(strings)
+    header = _header.pack(_magic, len(nodes) // _columns, len(types), len(arguments), len(string_offsets) - 1,
+                          len(strings), len(text))
+    return b''.join([header, nodes.tobytes(), types.tobytes(), starts.tobytes(), ends.tobytes(), owners.tobytes(),
+                     arguments.tobytes(), string_offsets.tobytes(), strings, text])
@@ -0,0 +1,194 @@
+from .base import *
+from .utilities import *
+from .frozen import *
+import hashlib
+import io
+
+
+class InternStore:
+    """
+    Shares the trees of identical included files between the configs parsed with it. Included files are keyed on a
+    hash of their content along with the state their parse depends on (ServerRoot, the ServerProfile's modules &
+    defines and the parse options), the first parse of each key is frozen and every later Include of an identical file
+    gets that same frozen ConfigFile. Holding many servers' trees then costs about as much as their distinct files.
+    The files a shared tree includes in turn are hashed again on every hit, the tree is parsed anew when one changed.
+
+    Shared ConfigFiles have no parent since they belong to several trees, use a ParentIndex to find the parents of
+    nodes within one tree. Directives of a shared file that change the parse, e.g. Define or ServerRoot, still update
+    the ServerProfile and Resolver of each parse that includes the file.
+
+    Example:
+    store = InternStore()
+    configs = [ConfigFile(file=path, store=store) for path in paths]
+    print(len(store), store.hits, store.misses)
+    """
+    def __init__(self):
+        # Key to (frozen tree, [(path, digest, size)] of the files it includes, directly or not, and the counts its
+        # parse added to ParseLimits, charged again on hits).
+        self._trees = {}
+        self.hits = 0
+        self.misses = 0
+        # Lists collecting the files loaded by the parses in progress, the innermost last.
+        self._loading = []
+
+    def __len__(self):
+        return len(self._trees)
+
+    def load(self, path, **options):
+        """
+        :param path: Resolved path of the file to load.
+        :param options: Parser options of the including parse.
+        :return: Frozen ConfigFile of path, shared with the other identical files loaded through this store.
+        """
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).digest()
+        key = (digest,) + _options_key(options)
+        entry = self._trees.get(key)
+        if entry is not None and any(_digest(included) != included_digest for included, included_digest, _ in entry[1]):
+            # A file the shared tree includes changed since it was parsed.
+            entry = None
+        if entry is None:
+            self.misses += 1
+            self._loading.append([])
+            try:
+                # Decoded like open() in text mode would, the file isn't read a second time.
+                configFile = ConfigFile(file=path, data=io.TextIOWrapper(io.BytesIO(content)).read(), **options)
+            finally:
+                included = self._loading.pop()
+            tree = freeze(configFile)
+            totals = _totals(tree)
+            totals['files'] = 1 + len(included)
+            totals['bytes'] = len(content) + sum(size for _, _, size in included)
+            self._trees[key] = (tree, included, totals)
+        else:
+            self.hits += 1
+            tree, included, totals = entry
+            # Limits are charged what parsing the files again would have cost.
+            if options.get('limits') is not None:
+                options['limits'].charge(**totals)
+            # The parse being skipped would have updated the profile & resolver, do it from the shared tree instead.
+            profile = options.get('profile')
+            resolver = options.get('resolver')
+            for node in _walk(tree):
+                if profile is not None:
+                    profile.observe(node)
+                if resolver is not None and isinstance(node, ServerRoot):
+                    resolver.observe(node)
+        if self._loading:
+            self._loading[-1].append((path, digest, len(content)))
+            self._loading[-1].extend(included)
+        return tree
+
+
+def _totals(tree):
+    # Nodes & tokens of a shared tree, and the deepest sections & includes and widest Include within it.
+    totals = {'nodes': 0, 'tokens': 0, 'depth': 0, 'include_depth': 0, 'fanout': 0}
+
+    def walk(node, depth, include_depth):
+        for child in node._children:
+            if isinstance(child, ConfigFile):
+                walk(child, depth, include_depth)
+                continue
+            totals['nodes'] += 1
+            totals['tokens'] += len(child._pretokens) + len(child._posttokens)
+            if isinstance(child, Include):
+                totals['include_depth'] = max(totals['include_depth'], include_depth + 1)
+                totals['fanout'] = max(totals['fanout'], len(child._children))
+                walk(child, depth, include_depth + 1)
+            elif isinstance(child, ScopedDirective):
+                totals['depth'] = max(totals['depth'], depth + 1)
+                walk(child, depth + 1, include_depth)
+    walk(tree, 0, 0)
+    return totals
+
+
+def _digest(path):
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).digest()
+    except OSError:
+        return None
+
+
+def _options_key(options):
+    profile = options.get('profile')
+    resolver = options.get('resolver')
+    select = options.get('select')
+    return (resolver.server_root if resolver is not None else None,
+            None if profile is None else (frozenset(profile.modules), frozenset(profile.defines.items()),
+                                          profile.prune),
+            bool(options.get('skeleton')), bool(options.get('weak_parents')),
+            # Parsers turn sets of names into the set's __contains__, compare the sets rather than the methods.
+            getattr(select, '__self__', select))
+
+
+def _walk(node):
+    # Active nodes in config order, following includes.
+    for child in node.children:
+        if child.active and not isinstance(child, Unparsed):
+            yield child
+            yield from _walk(child)
+
+
+class ParentIndex:
+    """
+    Parents & files of the nodes of one tree. Trees built with an InternStore share the ConfigFiles of included files,
+    which have no parent of their own, the index records the Include each one was loaded by in this tree.
+
+    A file included twice within the same tree is one shared ConfigFile, its nodes report the last place it was
+    included from.
+
+    Example:
+    index = ParentIndex(configFile)
+    vhost = index.parent(server_name)
+    file, line = index.locate(server_name)
+    """
+    def __init__(self, root):
+        self.root = root
+        self._parents = {}
+        self._files = {}
+        stack = [(root, None, root._file if isinstance(root, ConfigFile) else None)]
+        while stack:
+            node, parent, file = stack.pop()
+            self._parents[id(node)] = parent
+            self._files[id(node)] = file
+            if isinstance(node, Include):
+                paths = node._paths or [None] * len(node._children)
+                for child, path in zip(node._children, paths):
+                    stack.append((child, node, path if path is not None else child._file))
+            else:
+                for child in node._children:
+                    stack.append((child, node, file))
+
+    def __contains__(self, node):
+        return id(node) in self._parents
+
+    def parent(self, node):
+        """
+        :return: The node's parent within this tree, None for the root.
+        """
+        return self._parents[id(node)]
+
+    def ancestors(self, node):
+        """
+        :return: List of the node's ancestors, its parent first.
+        """
+        ancestors = []
+        parent = self._parents[id(node)]
+        while parent is not None:
+            ancestors.append(parent)
+            parent = self._parents[id(parent)]
+        return ancestors
+
+    def file(self, node):
+        """
+        :return: Path of the file the node was read from in this tree.
+        """
+        return self._files[id(node)]
+
+    def locate(self, node):
+        """
+        :return: (file, line) tuple like locate, with the file the node was read from in this tree.
+        """
+        return self.file(node), locate(node)[1]
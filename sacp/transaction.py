@@ -0,0 +1,420 @@
+from .base import *
+from .utilities import *
+import os
+import shutil
+import tempfile
+
+
+class TransactionError(Exception):
+    pass
+
+
+def _config_file(node):
+    while node is not None and not isinstance(node, ConfigFile):
+        node = node._parent
+    return node
+
+
+def _contains(ancestor, node, parent_of):
+    while node is not None:
+        if node is ancestor:
+            return True
+        node = parent_of(node)
+    return False
+
+
+def _leading(tokens):
+    """
+    :return: (count, text) of the whitespace tokens tokens start with, the line break & indentation before a node or a
+             close tag.
+    """
+    count = 0
+    while count < len(tokens) and tokens[count][0] is Token.Text.Whitespace:
+        count += 1
+    return count, ''.join(token[1] for token in tokens[:count])
+
+
+def _set_leading(tokens, text):
+    count = _leading(tokens)[0]
+    tokens[:count] = [(Token.Text.Whitespace, text)] if text else []
+
+
+def _ends_line(node):
+    # Whether the text of node ends with a line break, the files loaded by Includes aren't part of it.
+    while not node._posttokens and node._children and not isinstance(node, Include):
+        node = node._children[-1]
+    tokens = node._posttokens or node._pretokens
+    return bool(tokens) and tokens[-1][1].endswith('\n')
+
+
+def _line_start(parent, index):
+    # Whether the text before position index among parent's children ends with a line break.
+    if index:
+        return _ends_line(parent._children[index - 1])
+    if parent._pretokens:
+        return parent._pretokens[-1][1].endswith('\n')
+    return True
+
+
+def _following(parent, index):
+    """
+    :return: (owner, tokens) of what comes after position index among parent's children: the next child or parent's
+             close tag, (None, None) at the end of a file.
+    """
+    if index < len(parent._children):
+        node = parent._children[index]
+        return node, node._pretokens
+    if parent._posttokens:
+        return parent, parent._posttokens
+    return None, None
+
+
+def _breaks(tokens, line_start):
+    # Number of line breaks before tokens, at least one since every node & close tag starts a line of its own.
+    return max(_leading(tokens)[1].count('\n') + line_start, 1)
+
+
+def _place(tokens, breaks, line_start, indent):
+    _set_leading(tokens, '\n' * (breaks - line_start) + indent)
+
+
+def _indent(tokens):
+    return _leading(tokens)[1].rpartition('\n')[2]
+
+
+def _reindent(node, old, new, save):
+    # Moves the lines of node's children & close tag from indentation old to new, the way an editor shifts a block.
+    def shift(tokens):
+        breaks, newline, indent = _leading(tokens)[1].rpartition('\n')
+        if indent.startswith(old):
+            _set_leading(tokens, breaks + newline + new + indent[len(old):])
+    if isinstance(node, Include):
+        return
+    for child in node._children:
+        save(child)
+        shift(child._pretokens)
+        _reindent(child, old, new, save)
+    if node._posttokens:
+        shift(node._posttokens)
+
+
+class Transaction:
+    """
+    Batches edits to one or more trees. Edits are recorded first and nothing changes until commit, which validates
+    every edit, applies them all in one pass, invalidates each touched node once and then re-renders and writes each
+    affected ConfigFile exactly once. A committed transaction can be rolled back, restoring the trees (and files).
+
+    Inserted & moved nodes are put on lines of their own, indented like their new siblings, and the line breaks of the
+    nodes around an edit are kept, so the files written stay well formed.
+
+    Example:
+    with Transaction() as t:
+        for vhost in vhosts:
+            t.replace_arguments(vhost.server_alias, ['www.example.com'])
+            t.insert(vhost, '    Header set X-Frame-Options DENY\\n')
+    """
+    def __init__(self, write=True):
+        """
+        :param write: When True commit writes every affected ConfigFile to disk.
+        """
+        self._write = write
+        self._edits = []
+        self._saved = None
+        self._written = []
+
+    def insert(self, parent, node, index=None):
+        """
+        :param node: Node to insert, or config text which is parsed into nodes by commit.
+        :param index: Position among the parent's children, appended when None.
+        """
+        self._edits.append(('insert', parent, node, index))
+
+    def remove(self, node):
+        self._edits.append(('remove', node))
+
+    def replace_arguments(self, directive, arguments):
+        """
+        Replaces the arguments of a Directive or the header arguments of a ScopedDirective, the directive's name and
+        the whitespace around the arguments are kept.
+        """
+        self._edits.append(('arguments', directive, list(arguments)))
+
+    def move(self, node, parent, index=None):
+        self._edits.append(('move', node, parent, index))
+
+    def validate(self):
+        """
+        :raises TransactionError: Listing every edit that can't be applied.
+        """
+        problems = []
+        removed = set()
+        # Each edit is checked against the trees as the edits before it leave them, which are replayed on copies of
+        # the parent links & child lists they change.
+        parents = {}
+        children = {}
+
+        def parent_of(node):
+            return parents[id(node)] if id(node) in parents else node._parent
+
+        def children_of(parent):
+            if id(parent) not in children:
+                children[id(parent)] = list(parent._children)
+            return children[id(parent)]
+
+        def is_child(node):
+            parent = parent_of(node)
+            return parent is not None and any(child is node for child in children_of(parent))
+
+        def detach(node):
+            siblings = children_of(parent_of(node))
+            del siblings[[i for i, child in enumerate(siblings) if child is node][0]]
+            parents[id(node)] = None
+
+        def attach(parent, nodes, index):
+            siblings = children_of(parent)
+            for node in nodes:
+                parents[id(node)] = parent
+                removed.discard(id(node))
+            if index is None:
+                siblings.extend(nodes)
+            else:
+                siblings[index:index] = nodes
+
+        for edit in self._edits:
+            kind = edit[0]
+            if kind == 'insert':
+                parent, node, index = edit[1:]
+                if id(parent) in removed:
+                    problems.append("insert into a removed node")
+                elif isinstance(node, str):
+                    continue
+                elif not isinstance(node, Node):
+                    problems.append("can only insert Nodes")
+                elif parent_of(node) is not None:
+                    problems.append("node being inserted already has a parent, use move instead")
+                else:
+                    attach(parent, [node], index)
+            elif kind == 'remove':
+                node = edit[1]
+                if id(node) in removed:
+                    problems.append("node removed twice")
+                elif not is_child(node):
+                    problems.append("removed node is not a child of its parent")
+                else:
+                    detach(node)
+                    removed.add(id(node))
+            elif kind == 'arguments':
+                directive = edit[1]
+                if not isinstance(directive, Directive) or isinstance(directive, Include):
+                    problems.append("can only replace the arguments of a Directive")
+                elif id(directive) in removed:
+                    problems.append("replacing the arguments of a removed node")
+            elif kind == 'move':
+                node, parent, index = edit[1:]
+                if id(node) in removed or id(parent) in removed:
+                    problems.append("moving a removed node")
+                elif not is_child(node):
+                    problems.append("moved node is not a child of its parent")
+                elif _contains(node, parent, parent_of):
+                    problems.append("cannot move a node into itself")
+                else:
+                    detach(node)
+                    attach(parent, [node], index)
+        if problems:
+            raise TransactionError("; ".join(problems))
+
+    def commit(self):
+        """
+        Validates and applies all edits, then writes each affected file once.
+        :return: List of the ConfigFiles that were affected.
+        """
+        if self._saved is not None:
+            raise TransactionError("transaction already committed")
+        self.validate()
+        # Config text is parsed now, before anything changes, so Includes are resolved against the files as they are
+        # at commit and text that can't be parsed fails the whole transaction.
+        edits = []
+        for edit in self._edits:
+            if edit[0] == 'insert':
+                kind, parent, node, index = edit
+                edit = (kind, parent, Parser(data=node).nodes if isinstance(node, str) else [node], index)
+            edits.append(edit)
+        self._saved = []
+        saved = set()
+        touched = []
+
+        def save(node):
+            if id(node) not in saved:
+                saved.add(id(node))
+                self._saved.append((node, node._parent, list(node._pretokens), list(node._children),
+                                    list(node._posttokens)))
+                touched.append(node)
+
+        for edit in edits:
+            kind = edit[0]
+            if kind == 'insert':
+                parent, nodes, index = edit[1:]
+                save(parent)
+                for node in nodes:
+                    save(node)
+                    self._insert(parent, node, _breaks(node._pretokens, True), index, save)
+                    if index is not None:
+                        index += 1
+            elif kind == 'remove':
+                node = edit[1]
+                save(node)
+                save(node._parent)
+                self._remove(node, save)
+            elif kind == 'arguments':
+                save(edit[1])
+                self._replace_arguments(edit[1], edit[2])
+            elif kind == 'move':
+                node, parent, index = edit[1:]
+                save(node)
+                save(node._parent)
+                save(parent)
+                breaks = self._remove(node, save)
+                self._insert(parent, node, breaks, index, save)
+
+        files = self._affected(touched)
+        for node in touched:
+            node.invalidate()
+        if self._write:
+            try:
+                self._write_files(files)
+            except Exception:
+                self.rollback()
+                raise
+        return files
+
+    def rollback(self):
+        """
+        Discards pending edits, or undoes a committed transaction and rewrites the files it wrote.
+        """
+        if self._saved is None:
+            self._edits = []
+            return
+        touched = []
+        for node, parent, pretokens, children, posttokens in reversed(self._saved):
+            node._parent = parent
+            node._pretokens[:] = pretokens
+            node._children[:] = children
+            node._posttokens[:] = posttokens
+            touched.append(node)
+        for node in touched:
+            node.invalidate()
+        files = self._written
+        self._saved = None
+        self._edits = []
+        self._write_files(files)
+        self._written = []
+
+    def _affected(self, nodes):
+        files = []
+        seen = set()
+        for node in nodes:
+            for candidate in (node, node._parent):
+                cf = _config_file(candidate)
+                if cf is not None and id(cf) not in seen:
+                    seen.add(id(cf))
+                    files.append(cf)
+        return files
+
+    def _write_files(self, files):
+        self._written = []
+        for cf in files:
+            if cf._file:
+                _replace_file(cf)
+                self._written.append(cf)
+
+    @staticmethod
+    def _remove(node, save):
+        """
+        Removes node from its parent, what followed it keeps the line breaks it had.
+        :return: Number of line breaks before node.
+        """
+        parent = node._parent
+        index = [i for i, child in enumerate(parent._children) if child is node][0]
+        breaks = _breaks(node._pretokens, _line_start(parent, index))
+        owner, tokens = _following(parent, index + 1)
+        if owner is not None:
+            following = _breaks(tokens, _ends_line(node))
+            save(owner)
+        del parent._children[index]
+        if owner is not None:
+            _place(tokens, following, _line_start(parent, index), _indent(tokens))
+        return breaks
+
+    @staticmethod
+    def _insert(parent, node, breaks, index, save):
+        """
+        Inserts node at index, indented like its new siblings with breaks line breaks before it. What follows it keeps
+        the line breaks it had.
+        """
+        if index is None:
+            index = len(parent._children)
+        owner, tokens = _following(parent, index)
+        if owner is not None:
+            following = _breaks(tokens, _line_start(parent, index))
+            save(owner)
+        siblings = [child._pretokens for child in parent._children if child.type_token is not None]
+        if siblings:
+            indent = _indent(siblings[0])
+        elif parent._pretokens:
+            indent = _indent(parent._pretokens) + '    '
+        else:
+            indent = ''
+        old = _indent(node._pretokens)
+        node._parent = parent
+        parent._children.insert(index, node)
+        _place(node._pretokens, breaks, _line_start(parent, index), indent)
+        _reindent(node, old, indent, save)
+        if owner is not None:
+            _place(tokens, following, _ends_line(node), _indent(tokens))
+
+    @staticmethod
+    def _replace_arguments(directive, arguments):
+        tokens = directive._pretokens
+        start = tokens.index(directive.type_token) + 1
+        end = start
+        if isinstance(directive, ScopedDirective):
+            while end < len(tokens) and tokens[end][0] is not Token.Name.Tag:
+                end += 1
+            replacement = [(Token.Text.Whitespace, ' '), (Token.Literal.String, ' '.join(arguments))]
+        else:
+            # Keep the whitespace that ends the line, everything between it and the name is replaced.
+            end = len(tokens)
+            while end > start and '\n' in tokens[end - 1][1] and tokens[end - 1][1] != '\\\n':
+                end -= 1
+            replacement = []
+            for argument in arguments:
+                replacement.append((Token.Text.Whitespace, ' '))
+                replacement.append((Token.Text, argument))
+        tokens[start:end] = replacement
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        elif self._saved is not None:
+            self.rollback()
+        return False
+
+
+def _replace_file(cf):
+    # Written next to the file and moved over it, a write that fails part way leaves the file as it was.
+    if not cf.roundtrip:
+        raise ValueError("Skeleton configs can't be written, they don't hold the original text.")
+    path = os.path.realpath(cf._file)
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            cf.render_to(f)
+        if os.path.exists(path):
+            shutil.copymode(path, temporary)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
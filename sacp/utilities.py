@@ -1,4 +1,6 @@
 from .base import *
+import gc
+import time
 
 
 class LineEnumerator(NodeVisitor):
@@ -8,24 +10,187 @@ class LineEnumerator(NodeVisitor):
         self.lines = []
         self.visit(visitor=self.visitor)
 
-    def visit(self, visitor):
+    def visit(self, visitor, nodes=None):
         # We need to do depth-first node visit except for into Include or IncludeOptional.
-        for node in self._nodes:
+        for node in self._nodes if nodes is None else nodes:
             visitor(node)
             if isinstance(node, Include):
                 continue
             if node.children:
-                nv = LineEnumerator(node.children)
-                nv.visit(visitor)
+                self.visit(visitor, nodes=node.children)
+            # Closing tags, e.g. </VirtualHost>, take up lines too.
+            for token in node._posttokens:
+                self._lineno += token[1].count('\n')
 
     def visitor(self, node):
         if isinstance(node, ConfigFile):
             self._lineno = 1
         if node.type_token is None:
+            # Nodes without a type, e.g. Unparsed section bodies, still take up lines.
+            for token in node._pretokens:
+                self._lineno += token[1].count('\n')
             return
         type_index = node._pretokens.index(node.type_token)
         for token in node._pretokens[:type_index]:
             self._lineno += token[1].count('\n')    
-        self.lines.append((node, self._lineno))
+        self.lines.append((node, self._lineno if node._line is None else node._line))
         for token in node._pretokens[type_index:]:
             self._lineno += token[1].count('\n')
+
+
+def located_nodes(nodes, file=None):
+    """
+    Walks nodes depth-first, following Include and IncludeOptional into the files they load.
+    :param nodes: List of nodes to walk.
+    :param file: Name of the file the nodes were read from, ConfigFile nodes provide their own.
+    :return: Generator of (node, file, line) tuples for every node with a type, e.g. Comments & Directives.
+    """
+    return _located_nodes(nodes, file, [1])
+
+
+def _located_nodes(nodes, file, lineno):
+    for node in nodes:
+        if isinstance(node, ConfigFile):
+            yield node, node._file, 1
+            yield from _located_nodes(node.children, node._file, [1])
+            continue
+        type_token = node.type_token
+        if type_token is None:
+            for token in node._pretokens:
+                lineno[0] += token[1].count('\n')
+            continue
+        type_index = node._pretokens.index(type_token)
+        for token in node._pretokens[:type_index]:
+            lineno[0] += token[1].count('\n')
+        yield node, file, lineno[0] if node._line is None else node._line
+        for token in node._pretokens[type_index:]:
+            lineno[0] += token[1].count('\n')
+        if isinstance(node, Include):
+            # Included files keep their own line numbering.
+            yield from _located_nodes(node.children, file, [1])
+            continue
+        yield from _located_nodes(node.children, file, lineno)
+        for token in node._posttokens:
+            lineno[0] += token[1].count('\n')
+
+
+def iter_scope(nodes):
+    """
+    Walks the nodes that share the configuration context of nodes, e.g. the server config when given the top level
+    nodes of a ConfigFile, or a virtual host's config when given its children. Include, IncludeOptional, <IfModule> and
+    <IfDefine> are walked through since their contents belong to the surrounding context, other sections are yielded
+    but not walked into. Inactive and Unparsed nodes are skipped.
+    :return: Generator of nodes in config order.
+    """
+    for node in nodes:
+        if not node.active or isinstance(node, Unparsed):
+            continue
+        if isinstance(node, (ConfigFile, Include)):
+            yield from iter_scope(node.children)
+            continue
+        yield node
+        if isinstance(node, (IfModule, IfDefine)):
+            yield from iter_scope(node.children)
+
+
+def unquote(argument):
+    """
+    :return: argument without the double or single quotes surrounding it, e.g. '"/var/www"' returns '/var/www'.
+    """
+    if len(argument) > 1 and argument[0] == argument[-1] and argument[0] in '"\'':
+        return argument[1:-1]
+    return argument
+
+
+def locate(node):
+    """
+    Finds where a node was read from using the cached newline counts of the nodes before it, rather than walking the
+    whole file.
+    :return: (file, line) tuple, file is None for nodes that weren't read from a ConfigFile.
+    """
+    if node._line is not None:
+        parent = node._parent
+        while parent is not None and not isinstance(parent, ConfigFile):
+            parent = parent._parent
+        return (parent._file if parent is not None else None), node._line
+    line = 1
+    type_token = node.type_token
+    for token in node._pretokens:
+        if token is type_token:
+            break
+        line += token[1].count('\n')
+    child = node
+    parent = node._parent
+    while parent is not None and not isinstance(parent, ConfigFile):
+        for token in parent._pretokens:
+            line += token[1].count('\n')
+        line += _preceding_newlines(parent, child)
+        child = parent
+        parent = parent._parent
+    if parent is None:
+        return None, line
+    return parent._file, line + _preceding_newlines(parent, child)
+
+
+def _preceding_newlines(parent, child):
+    count = 0
+    for sibling in parent._children:
+        if sibling is child:
+            break
+        count += sibling.newlines
+    return count
+
+
+def freeze_gc():
+    """
+    Moves every object the garbage collector tracks into a permanent generation it no longer scans, so long-lived
+    trees, e.g. configs parsed once at startup, stop adding to the cost of every full collection. Call it after the
+    long-lived trees are built, objects created afterwards are collected as usual. gc.unfreeze() undoes it.
+    :return: Number of objects frozen.
+    """
+    gc.collect()
+    gc.freeze()
+    return gc.get_freeze_count()
+
+
+class GCPauses:
+    """
+    Measures the pauses of the cyclic garbage collector while it's active, e.g. to compare trees parsed with and
+    without weak_parents.
+
+    Example:
+    with GCPauses() as pauses:
+        configs = [ConfigFile(file=path, weak_parents=True) for path in paths]
+    print(pauses.count, pauses.total, pauses.longest)
+    """
+    def __init__(self):
+        # (generation, seconds, objects collected) for each collection.
+        self.pauses = []
+        self._start = None
+
+    def _callback(self, phase, info):
+        if phase == 'start':
+            self._start = time.perf_counter()
+        elif self._start is not None:
+            self.pauses.append((info['generation'], time.perf_counter() - self._start, info['collected']))
+            self._start = None
+
+    @property
+    def count(self):
+        return len(self.pauses)
+
+    @property
+    def total(self):
+        return sum(pause[1] for pause in self.pauses)
+
+    @property
+    def longest(self):
+        return max([pause[1] for pause in self.pauses] or [0.0])
+
+    def __enter__(self):
+        gc.callbacks.append(self._callback)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        gc.callbacks.remove(self._callback)
+        return False
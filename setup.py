@@ -9,6 +9,9 @@ setuptools.setup(
         install_requires=[
             'pygments>=2.8.1'
         ],
+        extras_require={
+            'numpy': ['numpy'],
+        },
         author='catatonicprime',
         author_email='catatonicprime@gmail.com',
         description='A simple Apache Config Parser',
@@ -1,6 +1,15 @@
 import unittest
 import os
 import tempfile
+import gc
+import gzip
+import io
+import pickle
+import socket
+import subprocess
+import sys
+import weakref
+import sacp.columnar
 from sacp import *
 
 
@@ -155,6 +164,18 @@ class TestDirective(unittest.TestCase):
         self.assertEqual(sn.name, "ServerName")
 
 
+class TestArguments(unittest.TestCase):
+    def test_split_tokens(self):
+        nodes = Parser(data='RewriteRule ^/old/(.*)$ /new/$1 [R=301,L]\nDeny from all\nHeader set X "a b"\n').nodes
+        self.assertEqual(nodes[0].arguments, ['^/old/(.*)$', '/new/$1', '[R=301,L]'])
+        self.assertEqual(nodes[1].arguments, ['from', 'all'])
+        self.assertEqual(nodes[2].arguments, ['set', 'X', '"a b"'])
+
+    def test_scoped_arguments(self):
+        nodes = Parser(data='<VirtualHost *:80 *:443>\n</VirtualHost>\n').nodes
+        self.assertEqual(nodes[0].arguments, ['*:80', '*:443'])
+
+
 class TestServerName(unittest.TestCase):
     def test_server_name(self):
         configFile = ConfigFile(file='files/small_vhost.conf')
@@ -199,6 +220,1116 @@ class TestServerAlias(unittest.TestCase):
         self.assertFalse(sa.isValid)
 
 
+class TestLintEngine(unittest.TestCase):
+    def test_default_rules(self):
+        findings = LintEngine().run([ConfigFile(file='files/bad_vhost.conf')])
+        self.assertEqual(len(findings), 2)
+        self.assertTrue(isinstance(findings[0].rule, ServerNameRule))
+        self.assertEqual(findings[0].file, 'files/bad_vhost.conf')
+        self.assertEqual(findings[0].line, 2)
+        self.assertTrue(isinstance(findings[1].rule, ServerAliasRule))
+        self.assertEqual(findings[1].line, 3)
+
+    def test_includes(self):
+        parser = Parser(data='ServerName bad/name\nInclude files/bad_vhost.conf\n')
+        findings = LintEngine().run(parser.nodes)
+        self.assertEqual([(f.file, f.line) for f in findings],
+                         [(None, 1), ('files/bad_vhost.conf', 2), ('files/bad_vhost.conf', 3)])
+
+    def test_custom_rule(self):
+        class PortRule(Rule):
+            name = 'vhost-port'
+            sections = ('VirtualHost',)
+
+            def check(self, node):
+                return [] if ':' in node.arguments[0] else ['missing port']
+
+        findings = LintEngine(rules=[PortRule()]).run(Parser(data='<VirtualHost host>\n</VirtualHost>').nodes)
+        self.assertEqual(len(findings), 1)
+        self.assertEqual(findings[0].message, 'missing port')
+        with self.assertRaises(ValueError):
+            LintEngine(rules=[object()])
+
+
+class TestServerProfile(unittest.TestCase):
+    def test_marks_inactive(self):
+        configFile = ConfigFile(file='files/conditional/httpd.conf', profile=ServerProfile(modules=['ssl']))
+        ssl, nossl, prod = configFile.children[1:4]
+        self.assertTrue(isinstance(ssl, IfModule))
+        self.assertTrue(ssl.children[0].active)
+        self.assertEqual(len(ssl.children[0].children), 1)
+        self.assertFalse(nossl.children[0].active)
+        self.assertTrue(isinstance(prod, IfDefine))
+        self.assertFalse(prod.children[0].active)
+        self.assertFalse(prod.children[1].children[0].active)
+        self.assertTrue(configFile.children[4].active)
+
+    def test_prune(self):
+        configFile = ConfigFile(file='files/conditional/httpd.conf', profile=ServerProfile(prune=True))
+        ssl = configFile.children[1]
+        self.assertEqual(len(ssl.children), 1)
+        self.assertTrue(isinstance(ssl.children[0], Unparsed))
+        with open('files/conditional/httpd.conf') as f:
+            self.assertEqual(str(configFile), f.read())
+        le = LineEnumerator(nodes=[configFile])
+        self.assertEqual(le.lines[-1][1], 14)
+
+    def test_inactive_include_not_loaded(self):
+        nodes = Parser(data='<IfModule missing_module>\nInclude nonexistent.conf\n</IfModule>\n',
+                       profile=ServerProfile()).nodes
+        self.assertFalse(nodes[0].children[0].active)
+        self.assertEqual(nodes[0].children[0].children, [])
+        with self.assertRaises(ValueError):
+            Parser(data='<IfModule missing_module>\nInclude nonexistent.conf\n</IfModule>\n')
+
+    def test_defines(self):
+        profile = ServerProfile(defines=['PROD'])
+        nodes = Parser(data='Define ROOT files\n<IfDefine PROD>\nInclude ${ROOT}/small_vhost.conf\n</IfDefine>\n'
+                            'UnDefine PROD\n<IfDefine !PROD>\nListen 80\n</IfDefine>\n', profile=profile).nodes
+        self.assertTrue(isinstance(nodes[0], Define))
+        self.assertEqual(profile.expand('${ROOT}/x'), 'files/x')
+        self.assertEqual(profile.expand('${UNKNOWN}'), '${UNKNOWN}')
+        self.assertTrue(isinstance(nodes[1].children[0].children[0], ConfigFile))
+        self.assertTrue(nodes[3].children[0].active)
+        self.assertFalse('PROD' in profile.defines)
+
+    def test_module_name(self):
+        self.assertEqual(module_name('mod_ssl.c'), 'ssl')
+        self.assertEqual(module_name('ssl_module'), 'ssl')
+        self.assertEqual(module_name('"mod_ssl"'), 'ssl')
+
+
+class TestEffectiveConfig(unittest.TestCase):
+    def test_overrides(self):
+        ec = EffectiveConfig(ConfigFile(file='files/effective.conf'))
+        self.assertEqual(ec.server.arguments('DocumentRoot'), ['/var/www/html'])
+        self.assertEqual(ec.server.arguments('SSLProtocol'), ['all', '-SSLv3'])
+        self.assertFalse('Options' in ec.server)
+        secure, plain = ec.virtual_hosts
+        self.assertEqual(ec.vhost(secure).arguments('DocumentRoot'), ['/var/www/secure'])
+        self.assertEqual(ec.vhost(secure).arguments('SSLProtocol'), ['-all', '+TLSv1.2'])
+        self.assertEqual(ec.vhost(secure).arguments('LogLevel'), ['warn'])
+        self.assertEqual(len(ec.vhost(secure).get_all('Header')), 2)
+        self.assertEqual(ec.vhost(plain).arguments('DocumentRoot'), ['/var/www/html'])
+        self.assertEqual(ec.vhost(plain).arguments('LogLevel'), ['debug'])
+        self.assertEqual(ec.vhost(plain).get('RewriteEngine'), None)
+
+    def test_memoized_and_invalidated(self):
+        configFile = ConfigFile(file='files/effective.conf')
+        ec = EffectiveConfig(configFile)
+        secure = ec.virtual_hosts[0]
+        self.assertTrue(ec.vhost(secure) is ec.vhost(secure))
+        secure.append_child(Parser(data='\n    LogLevel error\n').nodes[0])
+        self.assertEqual(ec.vhost(secure).arguments('LogLevel'), ['error'])
+
+    def test_profile(self):
+        configFile = ConfigFile(file='files/effective.conf', profile=ServerProfile())
+        ec = EffectiveConfig(configFile)
+        self.assertEqual(ec.vhost(ec.virtual_hosts[0]).get('SSLProtocol'), None)
+
+
+class TestSectionMatcher(unittest.TestCase):
+    def __init__(self, methodName="runTest"):
+        (unittest.TestCase).__init__(self, methodName=methodName)
+        self._config = ConfigFile(file='files/matcher.conf')
+        self._matcher = SectionMatcher([self._config])
+
+    def test_merge_order(self):
+        sections = self._matcher.match(url='/app/blog/edit', path='/var/www/1/uploads/a.png')
+        self.assertEqual([type(section) for section in sections],
+                         [Directory, Directory, Directory, DirectoryMatch, FilesMatch, Location, Location,
+                          LocationMatch])
+        self.assertEqual(sections[2].arguments, ['/var/www/*/uploads'])
+
+    def test_locations(self):
+        self.assertEqual([l.arguments for l in self._matcher.locations('/app')], [['/app']])
+        self.assertEqual(self._matcher.locations('/application'), [])
+        self.assertEqual(len(self._matcher.locations('/app/')), 2)
+
+    def test_nested_files(self):
+        self.assertEqual(len(self._matcher.files('/var/www/index.php')), 1)
+        self.assertEqual(self._matcher.files('/srv/index.php'), [])
+        self.assertEqual(len(self._matcher.files('/srv/.htaccess')), 1)
+
+    def test_vhost(self):
+        vhost = [node for node in self._config.children if isinstance(node, VirtualHost)][0]
+        sections = SectionMatcher([self._config], vhost=vhost).locations('/api/v2/users')
+        self.assertEqual([section.arguments for section in sections], [['~', '"/api/v[0-9]+"'], ['/']])
+
+    def test_regex_set(self):
+        regex_set = RegexSet(['^a(b)', 'c', r'(x)\1', 'd$'])
+        self.assertEqual(regex_set.matches('abxxd'), [0, 2, 3])
+        self.assertEqual(regex_set.matches('zzz'), [])
+        regex_set = RegexSet(['(?<name>a)', '(?<name>b)'])
+        self.assertEqual(regex_set.matches('b'), [1])
+
+
+class TestContentHash(unittest.TestCase):
+    def test_identical_trees(self):
+        left = ConfigFile(file='files/effective.conf')
+        right = ConfigFile(file='files/effective.conf')
+        self.assertEqual(left.content_hash, right.content_hash)
+        self.assertEqual(diff(left, right), [])
+
+    def test_invalidated(self):
+        configFile = ConfigFile(file='files/small_vhost.conf')
+        vhost = configFile.children[0]
+        before = configFile.content_hash
+        self.assertEqual(vhost.newlines, 4)
+        vhost.append_child(Parser(data='    LogLevel warn\n').nodes[0])
+        self.assertNotEqual(configFile.content_hash, before)
+        self.assertEqual(vhost.newlines, 5)
+
+    def test_locate(self):
+        configFile = ConfigFile(file='files/matcher.conf')
+        for node, file, line in located_nodes([configFile]):
+            if not isinstance(node, ConfigFile):
+                self.assertEqual(locate(node), (file, line))
+
+
+class TestDiff(unittest.TestCase):
+    def test_changes(self):
+        with open('files/effective.conf') as f:
+            data = f.read()
+        data = data.replace('LogLevel debug', 'LogLevel info')
+        data = data.replace('    Header set X-Vhost secure\n', '')
+        data = data.replace('LogLevel warn\n', 'LogLevel warn\nServerAdmin root@localhost\n')
+        with tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False) as f:
+            f.write(data)
+        try:
+            changes = diff(ConfigFile(file='files/effective.conf'), ConfigFile(file=f.name))
+        finally:
+            os.remove(f.name)
+        self.assertEqual([change.kind for change in changes], ['inserted', 'removed', 'modified'])
+        self.assertEqual(changes[0].right.name, 'ServerAdmin')
+        self.assertEqual(changes[0].location, (f.name, 4))
+        self.assertEqual(changes[1].left.name, 'Header')
+        self.assertEqual(changes[1].location, ('files/effective.conf', 15))
+        self.assertEqual(changes[2].left.arguments, ['debug'])
+        self.assertEqual(changes[2].right.arguments, ['info'])
+        self.assertEqual(changes[2].location, (f.name, 22))
+
+
+class TestTransaction(unittest.TestCase):
+    def setUp(self):
+        with open('files/effective.conf') as f:
+            self._original = f.read()
+        with tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False) as f:
+            f.write(self._original)
+        self._path = f.name
+        self._config = ConfigFile(file=self._path)
+        self._vhosts = [node for node in self._config.children if isinstance(node, VirtualHost)]
+
+    def tearDown(self):
+        os.remove(self._path)
+
+    def read(self):
+        with open(self._path) as f:
+            return f.read()
+
+    def test_commit_and_rollback(self):
+        secure, plain = self._vhosts
+        t = Transaction()
+        t.replace_arguments(secure.server_name, ['www.example.com'])
+        t.replace_arguments(plain, ['*:8080'])
+        t.insert(plain, '    Header set X-Frame-Options DENY\n')
+        t.remove(secure.children[2])
+        t.move(plain.children[1], secure, index=0)
+        directory = [node for node in self._config.children if isinstance(node, Directory)][0]
+        t.remove(directory.children[0])
+        t.move(secure.children[3], self._config, index=0)
+        files = t.commit()
+        self.assertEqual(files, [self._config])
+        data = self.read()
+        self.assertEqual(data, '<IfModule ssl_module>\n    SSLProtocol -all +TLSv1.2\n</IfModule>\n' +
+                         self._original[:self._original.index('<Directory')] +
+                         '<Directory /var/www>\n</Directory>\n'
+                         '<VirtualHost *:443>\n    LogLevel debug\n    ServerName www.example.com\n'
+                         '    DocumentRoot /var/www/secure\n</VirtualHost>\n'
+                         '<VirtualHost *:8080>\n    ServerName plain.example.com\n'
+                         '    Header set X-Frame-Options DENY\n</VirtualHost>\n')
+        self.assertEqual(secure.children[0].name, 'LogLevel')
+        self.assertEqual(data, str(self._config))
+        self.assertEqual(data, str(ConfigFile(file=self._path)))
+
+        t.rollback()
+        self.assertEqual(self.read(), self._original)
+        self.assertEqual(str(self._config), self._original)
+        self.assertEqual(plain.arguments, ['*:80'])
+
+    def test_validation(self):
+        secure, plain = self._vhosts
+        t = Transaction()
+        t.move(secure, secure.children[0])
+        t.insert(secure, secure.children[0])
+        t.replace_arguments(Node(), [])
+        with self.assertRaises(TransactionError):
+            t.commit()
+        self.assertEqual(self.read(), self._original)
+
+    def test_replayed_validation(self):
+        # Edits are validated against the trees the edits before them leave.
+        secure, plain = self._vhosts
+        node = Parser(data='    LogLevel info\n').nodes[0]
+        t = Transaction()
+        t.insert(secure, node, index=0)
+        t.move(node, plain)
+        t.remove(node)
+        t.commit()
+        self.assertEqual(self.read(), self._original)
+        t = Transaction()
+        t.remove(secure.children[0])
+        t.move(secure.children[0], plain)
+        with self.assertRaises(TransactionError):
+            t.commit()
+
+    def test_failed_write(self):
+        # Files are replaced once completely written, a failing write leaves the file as it was.
+        def render_to(f):
+            f.write('<VirtualHost')
+            raise OSError('disk full')
+        t = Transaction()
+        t.remove(self._vhosts[0])
+        self._config.render_to = render_to
+        with self.assertRaises(OSError):
+            t.commit()
+        self.assertEqual(self.read(), self._original)
+        self.assertEqual(str(self._config), self._original)
+        directory, name = os.path.split(self._path)
+        self.assertEqual([entry for entry in os.listdir(directory) if entry.startswith('.' + name)], [])
+
+    def test_context_manager(self):
+        secure = self._vhosts[0]
+        with self.assertRaises(RuntimeError):
+            with Transaction() as t:
+                t.remove(secure)
+                raise RuntimeError()
+        self.assertEqual(self.read(), self._original)
+        with Transaction() as t:
+            t.remove(secure)
+        self.assertFalse('secure' in self.read())
+
+
+class TestResolver(unittest.TestCase):
+    def test_cached_glob(self):
+        resolver = Resolver()
+        parser = Parser(data='Include files/glob/*.conf\nInclude files/glob/*.conf\nInclude files/glob\n',
+                        resolver=resolver)
+        self.assertEqual([len(node.children) for node in parser.nodes], [1, 1, 1])
+        self.assertEqual(parser.nodes[0].children[0]._file, 'files/glob/small_vhost.conf')
+        self.assertGreater(resolver.saved, 0)
+        calls = resolver.calls
+        Parser(data='Include files/glob/*.conf\n', resolver=resolver)
+        self.assertEqual(resolver.calls, calls)
+
+    def test_server_root(self):
+        root = os.path.join(os.getcwd(), 'files')
+        nodes = Parser(data='Include "glob/*.conf"\n', resolver=Resolver(server_root=root)).nodes
+        self.assertEqual(nodes[0].children[0]._file, os.path.join(root, 'glob', 'small_vhost.conf'))
+        nodes = Parser(data='ServerRoot "{}"\nInclude glob/*.conf\n'.format(root)).nodes
+        self.assertTrue(isinstance(nodes[0], ServerRoot))
+        self.assertEqual(len(nodes[1].children), 1)
+        configFile = ConfigFile(file='small_vhost.conf', resolver=Resolver(server_root=root))
+        self.assertEqual(configFile._file, os.path.join(root, 'small_vhost.conf'))
+
+    def test_no_match(self):
+        resolver = Resolver()
+        self.assertEqual(resolver.glob('files/glob/*.missing'), [])
+        self.assertEqual(resolver.glob('files/*/small_vhost.conf'), ['files/glob/small_vhost.conf'])
+
+    def test_symlink_loop(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'a.conf'), 'w') as f:
+                f.write('ServerName example.com\n')
+            os.symlink(directory, os.path.join(directory, 'loop'))
+            self.assertEqual(Resolver().glob(directory), [os.path.join(directory, 'a.conf')])
+            nodes = Parser(data='Include "{}"\n'.format(directory)).nodes
+            self.assertEqual(len(nodes[0].children), 1)
+
+
+class TestSkeleton(unittest.TestCase):
+    def test_same_structure(self):
+        full = ConfigFile(file='files/factory.conf')
+        skeleton = ConfigFile(file='files/factory.conf', skeleton=True)
+        expected = [(type(node), node.arguments, line) for node, file, line in located_nodes([full])
+                    if isinstance(node, Directive)]
+        actual = [(type(node), node.arguments, line) for node, file, line in located_nodes([skeleton])
+                  if isinstance(node, Directive)]
+        self.assertEqual(expected, actual)
+        self.assertFalse([node for node, file, line in located_nodes([skeleton]) if isinstance(node, Comment)])
+        self.assertLess(len(skeleton.tokens), len(full.tokens))
+
+    def test_lines(self):
+        configFile = ConfigFile(file='files/effective.conf', skeleton=True)
+        self.assertEqual(LineEnumerator(nodes=[configFile]).lines[-1][1], 22)
+        self.assertEqual(LineEnumerator(nodes=[ConfigFile(file='files/effective.conf')]).lines[-1][1], 22)
+        vhost = [node for node in configFile.children if isinstance(node, VirtualHost)][0]
+        self.assertEqual(locate(vhost.children[1]), ('files/effective.conf', 14))
+        nodes = Parser(data='# comment\nDirective multi\\\nline\nNext one\n', skeleton=True).nodes
+        self.assertEqual([node.arguments for node in nodes], [['multi', 'line'], ['one']])
+        self.assertEqual(locate(nodes[1]), (None, 4))
+
+    def test_pruned_lines(self):
+        profile = ServerProfile(prune=True)
+        full = ConfigFile(file='files/conditional/httpd.conf', profile=profile)
+        skeleton = ConfigFile(file='files/conditional/httpd.conf', profile=profile, skeleton=True)
+        self.assertEqual([locate(node) for node in skeleton.children if isinstance(node, Directive)],
+                         [locate(node) for node in full.children if isinstance(node, Directive)])
+
+    def test_roundtrip_flag(self):
+        configFile = ConfigFile(file='files/small_vhost.conf', skeleton=True)
+        self.assertFalse(configFile.roundtrip)
+        self.assertTrue(ConfigFile(file='files/small_vhost.conf').roundtrip)
+        with self.assertRaises(ValueError):
+            configFile.write()
+
+    def test_includes(self):
+        nodes = Parser(data='Include files/small_httpd.conf\n', skeleton=True).nodes
+        configFile = nodes[0].children[0]
+        self.assertFalse(configFile.roundtrip)
+        self.assertEqual([type(node) for node in configFile.children], [ServerName])
+
+
+class TestFrozen(unittest.TestCase):
+    def test_thaw_child_node(self):
+        # Thawed nodes don't keep their frozen parent, edits would run into it.
+        frozen = freeze(ConfigFile(file='files/effective.conf'))
+        vhost = [node for node in frozen.children if isinstance(node, VirtualHost)][0].thaw()
+        self.assertIsNone(vhost.parent)
+        vhost.append_child(Parser(data='    LogLevel info\n').nodes[0])
+        self.assertIn('LogLevel info', str(vhost))
+        self.assertNotIn('LogLevel info', str(frozen))
+
+    def test_pickle(self):
+        frozen = freeze(ConfigFile(file='files/effective.conf'))
+        copy = pickle.loads(pickle.dumps(frozen))
+        self.assertIs(type(copy), type(frozen))
+        self.assertEqual(str(copy), str(frozen))
+        self.assertTrue(all(token[0] is original[0] for token, original in zip(copy.tokens, frozen.tokens)))
+        vhost = [node for node in copy.children if isinstance(node, VirtualHost)][0]
+        self.assertIs(vhost.parent, copy)
+        self.assertEqual([node.arguments for node in copy.children if isinstance(node, Directive)],
+                         [node.arguments for node in frozen.children if isinstance(node, Directive)])
+        with self.assertRaises(FrozenError):
+            vhost.append_child(Node())
+        with self.assertRaises(FrozenError):
+            vhost._children = ()
+
+    def test_freeze(self):
+        configFile = ConfigFile(file='files/effective.conf')
+        frozen = freeze(configFile)
+        self.assertEqual(str(frozen), str(configFile))
+        self.assertEqual(frozen.content_hash, configFile.content_hash)
+        self.assertTrue(isinstance(frozen, ConfigFile))
+        self.assertTrue(isinstance(frozen.children, tuple))
+        vhost = [node for node in frozen.children if isinstance(node, VirtualHost)][0]
+        self.assertEqual(vhost.name, 'VirtualHost')
+        self.assertEqual(vhost.arguments, ('*:443',))
+        self.assertEqual(vhost.server_name.arguments, ('secure.example.com',))
+        self.assertEqual(vhost.children[0].depth, 2)
+        self.assertTrue(vhost.parent is frozen)
+        self.assertEqual(LineEnumerator(nodes=[frozen]).lines[-1][1], 22)
+        self.assertTrue(freeze(frozen) is frozen)
+
+    def test_immutable(self):
+        frozen = freeze(ConfigFile(file='files/small_vhost.conf'))
+        with self.assertRaises(FrozenError):
+            frozen.append_child(Node())
+        with self.assertRaises(FrozenError):
+            frozen.children[0]._parent = None
+        with self.assertRaises(AttributeError):
+            frozen.children[0].pretokens.append(None)
+
+    def test_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        frozen = freeze(ConfigFile(file='files/effective.conf'))
+        expected = str(frozen)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda i: str(frozen) + ''.join(
+                str(node.arguments) for node, file, line in located_nodes([frozen]) if isinstance(node, Directive)),
+                range(16)))
+        self.assertEqual(len(set(results)), 1)
+        self.assertTrue(results[0].startswith(expected))
+
+    def test_thaw(self):
+        frozen = freeze(ConfigFile(file='files/effective.conf'))
+        editable = frozen.thaw()
+        index = [i for i, node in enumerate(editable.children) if isinstance(node, VirtualHost)][0]
+        vhost = thaw_child(editable, index)
+        self.assertFalse(isinstance(vhost, Frozen))
+        self.assertTrue(editable.children[0] is frozen.children[0])
+        vhost.append_child(Parser(data='    LogLevel trace8\n').nodes[0])
+        self.assertTrue('LogLevel trace8' in str(editable))
+        self.assertFalse('LogLevel trace8' in str(frozen))
+        self.assertNotEqual(editable.content_hash, frozen.content_hash)
+
+
+class TestTokenColumns(unittest.TestCase):
+    def check_columns(self, use_numpy):
+        configFile = ConfigFile(file='files/effective.conf')
+        columns = TokenColumns(configFile, use_numpy=use_numpy)
+        self.assertEqual(len(columns), len(configFile.tokens))
+        self.assertEqual(columns.text, str(configFile))
+        self.assertEqual(columns.lines(), LineEnumerator(nodes=[configFile]).lines)
+        self.assertEqual(columns.token(0), configFile.tokens[0])
+        tags = [columns.token(i)[1] for i in columns.tokens_of_type(Token.Name.Tag)]
+        self.assertEqual(tags[:2], ['<IfModule', '>'])
+        named = [columns.nodes[i] for i in columns.nodes_named(['virtualhost', 'ServerName'])]
+        self.assertEqual([type(node) for node in named], [ServerName, VirtualHost, ServerName, VirtualHost,
+                                                          ServerName])
+        self.assertEqual(list(columns.token_lines([0, len(columns) - 1])), [1, 23])
+        self.assertFalse(columns.stale)
+        configFile.append_child(Node())
+        self.assertTrue(columns.stale)
+
+    def test_arrays(self):
+        self.check_columns(use_numpy=False)
+
+    @unittest.skipIf(sacp.columnar._import_numpy() is None, 'numpy is not installed')
+    def test_numpy(self):
+        self.check_columns(use_numpy=True)
+
+
+class TestStartup(unittest.TestCase):
+    # Runs in a fresh interpreter, the modules are already imported in this one.
+    script = '''
+import sys, time
+start = time.perf_counter()
+import sacp
+imported = time.perf_counter()
+heavy = [name for name in ('pygments.lexers', 'pygments.lexers.configs', 'numpy', 'difflib', 'concurrent.futures',
+                           'sqlite3', 'multiprocessing', 'multiprocessing.shared_memory') if name in sys.modules]
+sacp.Parser(data='ServerName www.example.com\\n')
+parsed = time.perf_counter()
+print(imported - start, parsed - imported, ' '.join(heavy))
+'''
+
+    def run_script(self):
+        output = subprocess.check_output([sys.executable, '-c', self.script],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)), universal_newlines=True)
+        import_time, parse_time, heavy = (output.rstrip('\n') + ' ').split(' ', 2)
+        return float(import_time), float(parse_time), heavy.split()
+
+    def test_lazy_imports(self):
+        self.assertEqual(self.run_script()[2], [])
+
+    def test_benchmark(self):
+        # Timings depend on the machine, so they're only reported, what startup guarantees is that the lexer tables
+        # and the process pool aren't loaded until they're used.
+        import_time, parse_time, heavy = self.run_script()
+        self.assertNotIn('pygments.lexers', heavy)
+        self.assertNotIn('multiprocessing', heavy)
+        sys.stderr.write('\nimport sacp: {:.3f}s, first parse: {:.3f}s\n'.format(import_time, parse_time))
+
+    def test_star_import(self):
+        namespace = {}
+        exec('from sacp import *', namespace)
+        for name in ('ApacheConfLexer', 'default', 'words', 'bygroups', 'include', 'using', 'Parser', 'locate'):
+            self.assertIn(name, namespace)
+
+    def test_shared_lexer(self):
+        first = sacp.base._default_lexer()
+        Parser(data='ServerName www.example.com\n')
+        self.assertIs(sacp.base._default_lexer(), first)
+        self.assertIsInstance(first, sacp.ApacheConfLexer)
+        with self.assertRaises(ValueError):
+            Parser(data='', acl=object())
+
+
+class TestWeakParents(unittest.TestCase):
+    def test_tree(self):
+        configFile = ConfigFile(file='files/conditional/httpd.conf', weak_parents=True)
+        self.assertEqual(str(configFile), str(ConfigFile(file='files/conditional/httpd.conf')))
+        nodes = [configFile]
+        while nodes:
+            node = nodes.pop()
+            for child in node.children:
+                self.assertIs(child.parent, node)
+                nodes.append(child)
+        include = configFile.children[1].children[0]
+        self.assertIsInstance(include, Include)
+        listen = include.children[0].children[0]
+        self.assertEqual(locate(listen), ('files/conditional/ssl.conf', 1))
+        self.assertEqual(listen.depth, 4)
+
+    def test_freed_without_gc(self):
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            configFile = ConfigFile(file='files/effective.conf', weak_parents=True)
+            child = weakref.ref(configFile.children[1])
+            root = weakref.ref(configFile)
+            del configFile
+            self.assertIsNone(root())
+            self.assertIsNone(child())
+            # Parents hold strong references to their children, the cycle keeps the tree alive until collected.
+            configFile = ConfigFile(file='files/effective.conf')
+            root = weakref.ref(configFile)
+            del configFile
+            self.assertIsNotNone(root())
+            gc.collect()
+            self.assertIsNone(root())
+        finally:
+            if enabled:
+                gc.enable()
+
+    def test_parent_freed(self):
+        vhost = ConfigFile(file='files/effective.conf', weak_parents=True).children[1]
+        self.assertIsNone(vhost.parent)
+
+    def test_gc_pauses(self):
+        with GCPauses() as pauses:
+            gc.collect()
+        self.assertGreaterEqual(pauses.count, 1)
+        self.assertEqual(pauses.pauses[-1][0], 2)
+        self.assertGreaterEqual(pauses.longest, 0.0)
+        self.assertNotIn(pauses._callback, gc.callbacks)
+
+    def test_freeze_gc(self):
+        configFile = ConfigFile(file='files/effective.conf')
+        try:
+            self.assertGreater(freeze_gc(), 0)
+        finally:
+            gc.unfreeze()
+        self.assertEqual(gc.get_freeze_count(), 0)
+
+
+class TestRenderTo(unittest.TestCase):
+    def setUp(self):
+        self.configFile = ConfigFile(file='files/effective.conf')
+        self.text = str(self.configFile)
+
+    def test_chunks(self):
+        chunks = list(self.configFile.iter_chunks(chunk_size=64))
+        self.assertEqual(''.join(chunks), self.text)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), 64)
+
+    def test_text_stream(self):
+        stream = io.StringIO()
+        self.assertEqual(self.configFile.render_to(stream, chunk_size=16), len(self.text))
+        self.assertEqual(stream.getvalue(), self.text)
+
+    def test_binary_streams(self):
+        stream = io.BytesIO()
+        self.configFile.render_to(stream)
+        self.assertEqual(stream.getvalue(), self.text.encode())
+        stream = io.BytesIO()
+        with gzip.GzipFile(fileobj=stream, mode='wb') as compressed:
+            self.configFile.render_to(compressed, chunk_size=32)
+        self.assertEqual(gzip.decompress(stream.getvalue()), self.text.encode())
+
+    def test_socket(self):
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            self.configFile.render_to(sender, chunk_size=32)
+            sender.shutdown(socket.SHUT_WR)
+            received = b''
+            data = receiver.recv(4096)
+            while data:
+                received += data
+                data = receiver.recv(4096)
+        self.assertEqual(received, self.text.encode())
+
+    def test_include_not_rendered(self):
+        include = Parser(data='Include files/small_vhost.conf').nodes[0]
+        self.assertEqual(''.join(include.iter_chunks()), str(include))
+
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'effective.conf')
+            with open(path, 'w') as f:
+                f.write(self.text)
+            configFile = ConfigFile(file=path)
+            configFile.children[0].append_child(Parser(data='    LogLevel debug\n').nodes[0])
+            configFile.write()
+            with open(path) as f:
+                self.assertEqual(f.read(), str(configFile))
+
+
+class TestSQLiteIndex(unittest.TestCase):
+    def test_export(self):
+        with SQLiteIndex() as index:
+            configFile = ConfigFile(file='files/conditional/httpd.conf')
+            self.assertEqual(index.export(configFile, 'web1'),
+                             ['files/conditional/httpd.conf', 'files/conditional/ssl.conf'])
+            self.assertEqual(index.find('listen'), [('web1', 'files/conditional/httpd.conf', 6, '80'),
+                                                    ('web1', 'files/conditional/ssl.conf', 1, '443')])
+            self.assertEqual(index.find('LogLevel', argument='warn'),
+                             [('web1', 'files/conditional/httpd.conf', 9, 'warn')])
+            self.assertEqual(index.find('LogLevel', argument='warn', server='web2'), [])
+            parent, = index.connection.execute(
+                "SELECT parent.class FROM nodes JOIN nodes AS parent ON parent.id = nodes.parent_id "
+                "WHERE nodes.name = 'RewriteEngine'").fetchone()
+            self.assertEqual(parent, 'IfModule')
+            include, = index.connection.execute(
+                "SELECT nodes.class FROM files JOIN nodes ON nodes.id = files.include_id "
+                "WHERE files.path = 'files/conditional/ssl.conf'").fetchone()
+            self.assertEqual(include, 'Include')
+            # Unchanged files are skipped.
+            self.assertEqual(index.export(ConfigFile(file='files/conditional/httpd.conf'), 'web1'), [])
+            self.assertEqual(len(index.find('listen')), 2)
+            index.export(configFile, 'web2')
+            self.assertEqual(len(index.find('listen')), 4)
+            index.forget('web2')
+            self.assertEqual(len(index.find('listen')), 2)
+
+    def test_incremental(self):
+        with tempfile.TemporaryDirectory() as directory:
+            main = os.path.join(directory, 'main.conf')
+            included = os.path.join(directory, 'included.conf')
+            with open(main, 'w') as f:
+                f.write('ServerName www.example.com\nInclude {}\n'.format(included))
+            with open(included, 'w') as f:
+                f.write('Listen 80\n')
+            database = os.path.join(directory, 'index.db')
+            with SQLiteIndex(database, batch_size=1) as index:
+                self.assertEqual(index.export(ConfigFile(file=main), 'web1'), [main, included])
+            with open(main, 'a') as f:
+                f.write('ServerAlias example.com\n')
+            with SQLiteIndex(database) as index:
+                self.assertEqual(index.export(ConfigFile(file=main), 'web1'), [main])
+                self.assertEqual(index.find('ServerAlias'), [('web1', main, 3, 'example.com')])
+                self.assertEqual(index.find('Listen'), [('web1', included, 1, '80')])
+                include, = index.connection.execute("SELECT include_id FROM files WHERE path = ?",
+                                                    (included,)).fetchone()
+                self.assertEqual(index.connection.execute("SELECT name FROM nodes WHERE id = ?",
+                                                          (include,)).fetchone(), ('Include',))
+            # Files no longer included are removed along with their nodes.
+            with open(main, 'w') as f:
+                f.write('ServerName www.example.com\n')
+            with SQLiteIndex(database) as index:
+                self.assertEqual(index.export(ConfigFile(file=main), 'web1'), [main])
+                self.assertEqual(index.find('Listen'), [])
+                self.assertEqual(index.connection.execute("SELECT path FROM files").fetchall(), [(main,)])
+                self.assertEqual(index.connection.execute("SELECT count(*) FROM arguments").fetchone(), (1,))
+
+
+class TestSelect(unittest.TestCase):
+    def test_names(self):
+        full = ConfigFile(file='files/effective.conf')
+        configFile = ConfigFile(file='files/effective.conf', select=['VirtualHost', 'servername'])
+        self.assertEqual(str(configFile), str(full))
+        types = [type(node) for node in configFile.children if node.type_token is not None]
+        self.assertEqual(types, [ServerName, IfModule, VirtualHost, VirtualHost])
+        vhost = configFile.children[7]
+        self.assertIsInstance(vhost, VirtualHost)
+        self.assertEqual(vhost.server_name.arguments, ['secure.example.com'])
+        self.assertIsInstance(vhost.children[2], Unparsed)
+        self.assertIsInstance(configFile.children[6], Unparsed)
+        self.assertEqual(str(configFile.children[6]), '\n<Directory /var/www>\n    Options None\n</Directory>')
+        lines = [line for node, line in LineEnumerator(nodes=[configFile]).lines if isinstance(node, ServerName)]
+        self.assertEqual(lines, [1, 13, 21])
+        self.assertEqual([line for node, file, line in located_nodes([configFile]) if isinstance(node, ServerName)],
+                         lines)
+
+    def test_predicate(self):
+        configFile = ConfigFile(file='files/effective.conf', select=lambda name: name.startswith('server'),
+                                skeleton=True)
+        directives = [node for node in configFile.children if isinstance(node, Directive)]
+        self.assertEqual([type(node) for node in directives], [ServerName, IfModule])
+        self.assertEqual([locate(node)[1] for node in directives], [1, 6])
+        self.assertIsInstance(directives[1].children[0], Unparsed)
+        self.assertEqual(sum(isinstance(node, Unparsed) for node in configFile.children), 7)
+
+    def test_includes(self):
+        # Includes of skipped sections are never loaded.
+        parser = Parser(data='<Directory /var/www>\n    Include nonexistent.conf\n</Directory>\n', select=[])
+        self.assertIsInstance(parser.nodes[0], Unparsed)
+        parser = Parser(data='Include files/small_vhost.conf\n', select=['ServerName'])
+        configFile = parser.nodes[0].children[0]
+        self.assertTrue(all(isinstance(node, (ServerName, Unparsed)) for node in configFile.children))
+        self.assertTrue(any(isinstance(node, ServerName) for node in configFile.children))
+
+    def test_unlexed(self):
+        # Skipped bodies are found by scanning the lines for the close tag, their text is kept without being lexed.
+        data = ('<VirtualHost *:80>\n    <Directory /a>\n    </Directory>\n    ServerName a\n</VirtualHost>\n'
+                '<Files a> # comment\n</Files>\nServerName b\n')
+        for skeleton in (False, True):
+            nodes = Parser(data=data, select=['ServerName'], skeleton=skeleton).nodes
+            self.assertEqual([type(node) for node in nodes if node.type_token is not None], [ServerName])
+            self.assertIn((Token.Text, '\n    <Directory /a>\n    </Directory>\n    ServerName a\n'), nodes[0].tokens)
+            self.assertEqual(nodes[0].tokens[-2:], [(Token.Name.Tag, '</VirtualHost'), (Token.Name.Tag, '>')])
+            self.assertEqual([line for node, file, line in located_nodes(nodes) if isinstance(node, ServerName)], [8])
+        self.assertEqual(''.join(str(node) for node in Parser(data=data, select=['ServerName']).nodes), data)
+
+
+class TestShardedParse(unittest.TestCase):
+    def setUp(self):
+        parts = ['# generated\nServerRoot "{}"\nListen 80\n'.format(os.getcwd())]
+        for i in range(40):
+            parts.append('<VirtualHost *:80>\n    ServerName h{0}.example.com\n    ServerAlias a{0}.example.com \\\n'
+                         '        b{0}.example.com\n    <Directory /var/www/{0}>\n        Options None\n'
+                         '    </Directory>\n</VirtualHost>\n\n# comment\n'.format(i))
+            if i % 10 == 0:
+                parts.append('Include files/small_vhost.conf\n')
+        self.data = ''.join(parts)
+
+    def check(self, **options):
+        sequential = Parser(data=self.data, **options).nodes
+        sharded = Parser(data=self.data, workers=2, shard_size=len(self.data) // 5, **options).nodes
+        self.assertEqual([type(node) for node in sharded], [type(node) for node in sequential])
+        tokens = [token for node in sharded for token in node.tokens]
+        self.assertEqual(tokens, [token for node in sequential for token in node.tokens])
+        self.assertTrue(all(token[0] is Token.Name.Tag for token in tokens if token[1] == '<VirtualHost'))
+        self.assertEqual([(type(node), file, line) for node, file, line in located_nodes(sharded)],
+                         [(type(node), file, line) for node, file, line in located_nodes(sequential)])
+        vhost = [node for node in sharded if isinstance(node, VirtualHost)][-1]
+        self.assertIs(vhost.children[-1].parent, vhost)
+        self.assertEqual(vhost.children[-1].depth, 1)
+        return sharded
+
+    def test_identical(self):
+        self.check()
+
+    def test_options(self):
+        self.check(skeleton=True)
+        self.check(weak_parents=True)
+        self.check(select=['VirtualHost', 'ServerName'])
+        with self.assertRaises(ValueError):
+            Parser(data=self.data, workers=2, shard_size=100, profile=ServerProfile())
+        with self.assertRaises(ValueError):
+            Parser(data=self.data, workers=2, shard_size=100, select=lambda name: name == 'servername')
+
+    def test_split_points(self):
+        shards = sacp.base._shards(self.data, 100)
+        self.assertEqual(shards[0][0], 0)
+        self.assertEqual(shards[-1][1], len(self.data))
+        for (start, end, line, server_root), following in zip(shards, shards[1:]):
+            self.assertEqual(end, following[0])
+            self.assertEqual(self.data[end - len('</VirtualHost>'):end], '</VirtualHost>')
+            self.assertEqual(self.data.count('\n', 0, following[0]) + 1, following[2])
+            self.assertEqual(following[3], os.getcwd())
+        # Never split inside a section or a continued line.
+        data = '<A>\n<B>\n</B>\n</A>\n<C>\n</C>\n'
+        self.assertEqual([data[start:end] for start, end, line, server_root in sacp.base._shards(data, 1)],
+                         ['<A>\n<B>\n</B>\n</A>', '\n<C>\n</C>', '\n'])
+        data = 'Header set X "a\n</B>\n" \\\n</C>\n<D>\n</D>'
+        self.assertEqual(len(sacp.base._shards(data, 1)), 1)
+
+
+class TestInternStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.roots = []
+        for server in ('web1', 'web2', 'web3'):
+            os.mkdir(os.path.join(self.directory.name, server))
+            modules = os.path.join(self.directory.name, server, 'modules.conf')
+            with open(modules, 'w') as f:
+                f.write('LoadModule ssl_module modules/mod_ssl.so\nDefine SHARED\n')
+            root = os.path.join(self.directory.name, server, 'httpd.conf')
+            with open(root, 'w') as f:
+                f.write('ServerName {}.example.com\nInclude {}\n<IfDefine SHARED>\n    Listen 443\n</IfDefine>\n'
+                        .format(server, modules))
+            self.roots.append(root)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_shared(self):
+        store = InternStore()
+        configs = [ConfigFile(file=root, store=store, profile=ServerProfile()) for root in self.roots]
+        self.assertEqual((len(store), store.hits, store.misses), (1, 2, 1))
+        shared = [configFile.children[1].children[0] for configFile in configs]
+        self.assertIs(shared[0], shared[1])
+        self.assertIs(shared[1], shared[2])
+        self.assertIsInstance(shared[0], Frozen)
+        with self.assertRaises(FrozenError):
+            shared[0].append_child(Node())
+        # Defines of the shared file still apply to each server.
+        for configFile in configs:
+            self.assertTrue(configFile.children[2].children[0].active)
+            self.assertEqual(str(configFile), str(ConfigFile(file=configFile._file)))
+        # A different profile state is a different key.
+        ConfigFile(file=self.roots[0], store=store, profile=ServerProfile(defines=['OTHER']))
+        self.assertEqual(len(store), 2)
+
+    def test_nested_change(self):
+        # Shared trees are only reused while the files they include are unchanged too.
+        nested = os.path.join(self.directory.name, 'nested.conf')
+        with open(nested, 'w') as f:
+            f.write('Listen 80\n')
+        for server in ('web1', 'web2'):
+            with open(os.path.join(self.directory.name, server, 'modules.conf'), 'w') as f:
+                f.write('Include {}\n'.format(nested))
+        store = InternStore()
+        first = ConfigFile(file=self.roots[0], store=store)
+        with open(nested, 'w') as f:
+            f.write('Listen 8080\n')
+        second = ConfigFile(file=self.roots[1], store=store)
+        self.assertEqual(store.hits, 0)
+        self.assertIn('Listen 80\n', str(first.children[1].children[0].children[0].children[0]))
+        self.assertIn('Listen 8080\n', str(second.children[1].children[0].children[0].children[0]))
+        third = ConfigFile(file=self.roots[1], store=store)
+        self.assertEqual((store.hits, store.misses), (1, 4))
+        self.assertIs(third.children[1].children[0], second.children[1].children[0])
+
+    def test_limits(self):
+        # Shared trees count against the limits of every parse they're used by, like the files they stand for.
+        store = InternStore()
+        ConfigFile(file=self.roots[0], store=store)
+        plain, shared = ParseLimits(), ParseLimits()
+        ConfigFile(file=self.roots[1], limits=plain)
+        ConfigFile(file=self.roots[1], store=store, limits=shared)
+        self.assertEqual(store.hits, 1)
+        self.assertEqual((shared.files, shared.bytes, shared.nodes, shared.tokens),
+                         (plain.files, plain.bytes, plain.nodes, plain.tokens))
+        with self.assertRaises(LimitExceeded):
+            ConfigFile(file=self.roots[2], store=store, limits=ParseLimits(max_files=1))
+        with self.assertRaises(LimitExceeded):
+            ConfigFile(file=self.roots[2], store=store, limits=ParseLimits(max_nodes=plain.nodes - 1))
+
+    def test_parent_index(self):
+        store = InternStore()
+        configs = [ConfigFile(file=root, store=store) for root in self.roots]
+        define = configs[1].children[1].children[0].children[1]
+        self.assertIsInstance(define, Define)
+        index = ParentIndex(configs[1])
+        self.assertIn(define, index)
+        self.assertIs(index.parent(configs[1].children[1].children[0]), configs[1].children[1])
+        self.assertEqual(index.ancestors(define), [define.parent, configs[1].children[1], configs[1]])
+        modules = os.path.join(self.directory.name, 'web2', 'modules.conf')
+        self.assertEqual(index.locate(define), (modules, 2))
+        self.assertEqual(ParentIndex(configs[2]).file(define), modules.replace('web2', 'web3'))
+        self.assertIsNone(index.parent(configs[1]))
+
+
+class TestParseLimits(unittest.TestCase):
+    def assertExceeds(self, limit, function, *args, **kwargs):
+        with self.assertRaises(LimitExceeded) as context:
+            function(*args, **kwargs)
+        self.assertEqual(context.exception.limit, limit)
+        return context.exception.stats
+
+    def test_within_limits(self):
+        limits = ParseLimits(max_bytes=10000, max_tokens=10000, max_nodes=1000, max_depth=3, timeout=60)
+        configFile = ConfigFile(file='files/effective.conf', limits=limits)
+        self.assertEqual(limits.tokens, len(configFile.tokens))
+        self.assertEqual(limits.bytes, len(str(configFile)))
+        self.assertEqual((limits.files, limits.depth), (1, 0))
+
+    def test_counts(self):
+        stats = self.assertExceeds('bytes', ConfigFile, file='files/effective.conf', limits=ParseLimits(max_bytes=100))
+        self.assertEqual(stats['bytes'], 0)
+        stats = self.assertExceeds('tokens', Parser, data='ServerName a\nServerAlias b c\n',
+                                   limits=ParseLimits(max_tokens=5))
+        self.assertEqual(stats['tokens'], 6)
+        stats = self.assertExceeds('nodes', ConfigFile, file='files/effective.conf', limits=ParseLimits(max_nodes=3))
+        self.assertEqual(stats['nodes'], 4)
+        self.assertExceeds('depth', Parser, data='<A>\n<B>\n<C>\n</C>\n</B>\n</A>\n',
+                           limits=ParseLimits(max_depth=2))
+
+    def test_includes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'loop.conf')
+            with open(path, 'w') as f:
+                f.write('Include {}\n'.format(path))
+            stats = self.assertExceeds('include depth', ConfigFile, file=path,
+                                       limits=ParseLimits(max_include_depth=3))
+            self.assertEqual(stats['files'], 4)
+            self.assertExceeds('files', ConfigFile, file=path, limits=ParseLimits(max_files=5))
+        self.assertExceeds('fanout', Parser, data='Include files/*.conf\n', limits=ParseLimits(max_fanout=2))
+        self.assertEqual(len(Resolver().glob('files', limit=2)), 3)
+
+    def test_include_expansion(self):
+        # Patterns that match large directory trees stop expanding once over the limits.
+        resolver = Resolver()
+        self.assertExceeds('files', Parser, data='Include /usr\n', resolver=resolver,
+                           limits=ParseLimits(timeout=5, max_files=10))
+        self.assertLess(resolver.calls, 1000)
+        token = CancelToken()
+        token.cancel()
+        resolver = Resolver()
+        with self.assertRaises(Cancelled):
+            Parser(data='Include /*\n', resolver=resolver, limits=ParseLimits(cancel=token))
+        self.assertEqual(resolver.calls, 0)
+
+    def test_bytes(self):
+        limits = ParseLimits()
+        Parser(data='ServerName \u00e9xample.com\n', limits=limits)
+        self.assertEqual(limits.bytes, len('ServerName \u00e9xample.com\n') + 1)
+
+    def test_timeout_and_cancel(self):
+        data = str(ConfigFile(file='files/effective.conf')) * 50
+        stats = self.assertExceeds('timeout', Parser, data=data, limits=ParseLimits(timeout=0))
+        self.assertEqual(stats['tokens'], ParseLimits.check_interval)
+        token = CancelToken()
+        token.cancel()
+        with self.assertRaises(Cancelled):
+            ConfigFile(file='files/effective.conf', limits=ParseLimits(cancel=token))
+
+
+class TestRecover(unittest.TestCase):
+    def test_lex_errors(self):
+        configFile = ConfigFile(file='files/lex_errors.conf', recover=True)
+        with open('files/lex_errors.conf') as f:
+            self.assertEqual(str(configFile), f.read())
+        self.assertEqual([type(node) for node in configFile.children], [Directive, ErrorNode, Directive])
+        self.assertEqual(configFile.children[2].arguments, ['Directive2'])
+        diagnostic, = configFile.diagnostics
+        self.assertIs(diagnostic.node, configFile.children[1])
+        self.assertEqual(diagnostic.location, ('files/lex_errors.conf', 2))
+        skeleton = ConfigFile(file='files/lex_errors.conf', recover=True, skeleton=True)
+        self.assertEqual([d.location for d in skeleton.diagnostics], [('files/lex_errors.conf', 2)])
+
+    def test_include_tree(self):
+        with tempfile.TemporaryDirectory() as directory:
+            included = os.path.join(directory, 'included.conf')
+            with open(included, 'w') as f:
+                f.write('Listen 80\n~oops\nListen 443\n')
+            main = os.path.join(directory, 'main.conf')
+            with open(main, 'w') as f:
+                f.write('Include {}\nInclude {}/missing.conf\nIncludeOptional {}/optional.conf\n'
+                        '<VirtualHost *:80>\n    ServerName www.example.com\n'.format(included, directory, directory))
+            configFile = ConfigFile(file=main, recover=True)
+            self.assertEqual([(d.file, d.line) for d in configFile.diagnostics],
+                             [(included, 2), (main, 2), (main, 4)])
+            self.assertTrue(configFile.diagnostics[1].message.endswith('matched no files'))
+            self.assertEqual(str(configFile.diagnostics[0]), "{}:2: can't parse '~oops'".format(included))
+            listen = configFile.children[0].children[0].children[2]
+            self.assertEqual(listen.arguments, ['443'])
+            with self.assertRaises(ValueError):
+                ConfigFile(file=main)
+            # Files shared through a store are parsed once, their diagnostics couldn't be reported to later parses.
+            with self.assertRaises(ValueError):
+                ConfigFile(file=main, recover=True, store=InternStore())
+
+    def test_close_tags(self):
+        # Close tags are matched by name, those that close no open section are reported and kept as ErrorNodes.
+        cases = [('<VirtualHost *:80>\n    <Directory "/x\n>\n    </Directory>\n    ServerName a\n</VirtualHost>\n',
+                  [(2, "can't parse '<Directory \"/x'"), (3, "can't parse '>'"),
+                   (4, "</Directory> doesn't close an open section")], [VirtualHost]),
+                 ('<Directory /x>\n    Options None\n</Location>\nListen 80\n',
+                  [(3, "</Location> doesn't close an open section"), (1, '<Directory> is never closed')], [Directory]),
+                 ('Listen 80\n</Directory>\nListen 81\n', [(2, "</Directory> doesn't close an open section")],
+                  [Directive, ErrorNode, Directive]),
+                 ('<VirtualHost *:80>\n    <Directory /x>\n    Options None\n</VirtualHost>\nListen 80\n',
+                  [(2, '<Directory> is never closed')], [VirtualHost, Directive])]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'httpd.conf')
+            for data, diagnostics, types in cases:
+                with open(path, 'w') as f:
+                    f.write(data)
+                configFile = ConfigFile(file=path, recover=True)
+                self.assertEqual(str(configFile), data)
+                self.assertEqual([(d.line, d.message) for d in configFile.diagnostics], diagnostics)
+                self.assertEqual([type(node) for node in configFile.children if type(node) is not Node], types)
+                if types[0] is VirtualHost:
+                    self.assertEqual(configFile.children[0].posttokens[-2][1], '</VirtualHost')
+
+
+
+class TestRewrite(unittest.TestCase):
+    def __init__(self, methodName="runTest"):
+        (unittest.TestCase).__init__(self, methodName=methodName)
+        self._config = ConfigFile(file='files/rewrite.conf')
+        self._vhosts = [node for node in self._config.children if isinstance(node, VirtualHost)]
+
+    def test_flags(self):
+        self.assertEqual(parse_flags('[L,NC,R=301]'), {'L': None, 'NC': None, 'R': '301'})
+        self.assertEqual(parse_flags('-'), {})
+
+    def test_redirect_or_conditions(self):
+        chain = RewriteChain(self._vhosts[0].children)
+        self.assertTrue(chain.enabled)
+        self.assertEqual(len(chain.rules), 7)
+        for host in ('EXAMPLE.com', 'old.example.com'):
+            result = chain.evaluate('/foo', host)
+            self.assertEqual((result.url, result.status, result.rules), ('http://www.example.com/foo', 301, [0]))
+        self.assertFalse(chain.evaluate('/foo', 'www.example.com').redirect)
+
+    def test_chain_and_query(self):
+        chain = RewriteChain(self._vhosts[0].children)
+        self.assertEqual(chain.evaluate('/docs/x.html', 'www.example.com', 'q=2').url, '/manual/x.php?lang=en&q=2')
+        # The chained rule is skipped when the rule before it doesn't match.
+        self.assertEqual(chain.evaluate('/manual/x.html').url, '/manual/x.html')
+        self.assertEqual(chain.evaluate('/docs/x.txt').url, '/manual/x.txt')
+        self.assertEqual(chain.evaluate('/b', query='q=1').url, '/c')
+        self.assertEqual(chain.evaluate('/a').url, '/b')
+        self.assertEqual(chain.evaluate('/b').url, '/d')
+
+    def test_back_references(self):
+        chain = RewriteChain(self._vhosts[0].children)
+        result = chain.evaluate('/OLD/page', 'www.example.com')
+        self.assertEqual((result.url, result.status), ('/new/www/page', 302))
+
+    def test_per_directory(self):
+        directory = [node for node in self._config.children if isinstance(node, Directory)][0]
+        chain = RewriteChain(directory.children, prefix='/app')
+        self.assertEqual(chain.evaluate('/app/index.php').url, '/app/index.php')
+        self.assertEqual(chain.evaluate('/app/x/y', query='a=1').url, '/app/index.php?path=x/y&a=1')
+
+    def test_engine_off(self):
+        chain = RewriteChain(self._vhosts[1].children)
+        self.assertFalse(chain.enabled)
+        self.assertEqual(chain.evaluate('/x').url, '/x')
+        self.assertEqual(chain.hits, [0])
+
+    def test_evaluate_many(self):
+        chain = RewriteChain(self._vhosts[0].children)
+        requests = [('/foo', 'example.com'), '/a', ('/docs/x.html', 'www.example.com', 'q=2'), '/a'] * 50
+        results = chain.evaluate_many(requests)
+        self.assertEqual(results, [chain.evaluate(*((r,) if isinstance(r, str) else r)) for r in requests])
+        self.assertEqual(chain.hits, [100, 100, 100, 200, 0, 0, 0])
+        self.assertEqual(locate(chain.rules[0].node), ('files/rewrite.conf', 7))
+
+
+def _shared_tree_names(name):
+    # Runs in a worker process of TestSharedTree.
+    tree = SharedTree.attach(name)
+    names = [child.name for child in tree.root.children]
+    tree.close()
+    return names
+
+
+class TestSharedTree(unittest.TestCase):
+    def check(self, node, view):
+        self.assertEqual(str(view), str(node))
+        self.assertEqual(view.type_name, type(node).__name__)
+        self.assertIs(view.node_class, type(node))
+        self.assertEqual(view.active, node.active)
+        if isinstance(node, Directive):
+            self.assertEqual((view.name, view.arguments), (node.name, node.arguments))
+        else:
+            self.assertIsNone(view.name)
+        self.assertEqual(view.tokens, node.tokens)
+        if not isinstance(node, ConfigFile):
+            self.assertEqual(view.locate(), locate(node))
+        self.assertEqual(len(view.children), len(node.children))
+        for child, child_view in zip(node.children, view.children):
+            self.assertEqual(child_view.parent, view)
+            self.check(child, child_view)
+
+    def test_views(self):
+        configFile = ConfigFile(file='files/matcher.conf')
+        with SharedTree.publish(configFile) as published:
+            tree = SharedTree.attach(published.name)
+            self.check(configFile, tree.root)
+            self.assertIs(tree.root.tokens[0][0], configFile.tokens[0][0])
+            self.assertEqual(len(tree), 27)
+            with self.assertRaises(TypeError):
+                tree._text[0] = 0
+            tree.close()
+
+    def test_includes(self):
+        configFile = ConfigFile(file='files/conditional/httpd.conf', profile=ServerProfile(modules=['ssl']))
+        with SharedTree.publish(configFile) as tree:
+            self.check(configFile, tree.root)
+            include = tree.root.children[1].children[0]
+            self.assertEqual(str(include), str(configFile.children[1].children[0]))
+            included = include.children[0]
+            self.assertEqual((included.file, included.children[0].name), ('files/conditional/ssl.conf', 'Listen'))
+
+    def test_workers(self):
+        import multiprocessing
+        configFile = ConfigFile(file='files/small_vhost.conf')
+        with SharedTree.publish(configFile) as tree:
+            with multiprocessing.Pool(2) as pool:
+                results = pool.map(_shared_tree_names, [tree.name] * 2)
+        self.assertEqual(results, [[getattr(node, 'name', None) for node in configFile.children]] * 2)
+
+
 class TestConfigFile(unittest.TestCase):
     def test_write(self):
         testPath = tempfile.TemporaryFile().name